@@ -0,0 +1,252 @@
+"""
+Backplanes spread published messages to all the processes running the application,
+so that long-polling works when running several workers:
+
+    uvicorn server:app --workers 4
+
+Without a backplane, a message published to one worker would only reach the
+subscribers parked on the same process.
+"""
+import asyncio
+import fcntl
+import json
+import os
+import random
+from abc import ABC, abstractmethod
+from typing import Callable
+
+# Called with the id assigned to a message (None to let the receiver assign it), the
+# topic, and the message itself
+DeliverCallback = Callable[[int | None, str, str], None]
+
+
+class BackplaneUnavailableError(Exception):
+    """
+    Raised when a message cannot be published, because no hub can be reached.
+    """
+
+    def __init__(self) -> None:
+        super().__init__("The backplane is not connected to a hub.")
+
+
+class Backplane(ABC):
+    """
+    Base class for backplanes. A backplane receives messages published by the local
+    process, and delivers to the local process all messages published by any process,
+    in the same order for all processes.
+    """
+
+    @property
+    def info(self) -> dict:
+        """Returns information about the backplane, to be displayed in stats."""
+        return {"type": type(self).__name__}
+
+    @abstractmethod
+    async def start(self, deliver: DeliverCallback) -> None:
+        """Starts the backplane, which delivers messages using the given callback."""
+
+    @abstractmethod
+    async def publish(self, topic: str, message: str) -> None:
+        """Publishes a message to a topic, in all the processes."""
+
+    @abstractmethod
+    async def stop(self) -> None:
+        """Stops the backplane."""
+
+
+class LocalBackplane(Backplane):
+    """
+    Backplane for a single process: messages are delivered directly to the local
+    process.
+    """
+
+    def __init__(self) -> None:
+        self._deliver: DeliverCallback | None = None
+
+    async def start(self, deliver: DeliverCallback) -> None:
+        self._deliver = deliver
+
+    async def publish(self, topic: str, message: str) -> None:
+        assert self._deliver is not None, "The backplane is not started"
+        self._deliver(None, topic, message)
+
+    async def stop(self) -> None:
+        self._deliver = None
+
+
+class UnixSocketBackplane(Backplane):
+    """
+    Backplane for processes running on the same machine, communicating through a
+    Unix socket. It does not require any external service.
+
+    One of the processes acts as hub: it listens on the Unix socket, the other
+    processes connect to it. The hub is elected using an exclusive lock on a file,
+    which the operating system releases when the hub process exits: the other
+    processes then elect a new hub.
+
+    All messages go through the hub, which assigns them a sequence id and relays
+    them to all processes (itself included) in the same order. Messages are
+    exchanged as JSON lines.
+
+    Publishing fails with BackplaneUnavailableError if no hub can be reached
+    within publish_timeout seconds. The hub never waits for a process to read the
+    messages relayed to it: a process with more than max_buffer_size bytes not
+    read yet is disconnected, and connects again.
+    """
+
+    def __init__(
+        self,
+        path: str = "/tmp/blacksheep-long-polling.sock",
+        publish_timeout: float = 5,
+        max_buffer_size: int = 4 * 1024 * 1024,
+    ) -> None:
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.publish_timeout = publish_timeout
+        self.max_buffer_size = max_buffer_size
+        self.dropped_members = 0
+        self._deliver: DeliverCallback | None = None
+        self._last_id = 0
+        self._is_hub = False
+        self._members: set[asyncio.StreamWriter] = set()
+        self._hub_writer: asyncio.StreamWriter | None = None
+        self._connected = asyncio.Event()
+        self._lock_file: int | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def info(self) -> dict:
+        return {
+            "type": type(self).__name__,
+            "path": self.path,
+            "role": "hub" if self._is_hub else "member",
+            "members": len(self._members),
+            "dropped_members": self.dropped_members,
+        }
+
+    async def start(self, deliver: DeliverCallback) -> None:
+        self._deliver = deliver
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        for writer in self._members:
+            writer.close()
+        if self._hub_writer is not None:
+            self._hub_writer.close()
+        if self._lock_file is not None:
+            # Closing the file releases the lock
+            os.close(self._lock_file)
+            self._lock_file = None
+
+    async def publish(self, topic: str, message: str) -> None:
+        if self._is_hub:
+            self._relay(topic, message)
+            return
+
+        frame = json.dumps({"topic": topic, "text": message}).encode() + b"\n"
+        try:
+            async with asyncio.timeout(self.publish_timeout):
+                await self._connected.wait()
+                assert self._hub_writer is not None
+                self._hub_writer.write(frame)
+                await self._hub_writer.drain()
+        except TimeoutError:
+            raise BackplaneUnavailableError()
+
+    def _try_acquire_lock(self) -> bool:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_file = fd
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            if self._try_acquire_lock():
+                await self._serve()
+                return
+
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The hub is starting, or was just elected
+                await asyncio.sleep(0.1)
+                continue
+
+            await self._follow_hub(reader, writer)
+
+            # The hub went away: wait a random time before electing a new one, so
+            # that the other processes don't all compete at the same instant
+            await asyncio.sleep(random.uniform(0, 0.2))
+
+    async def _serve(self) -> None:
+        # The socket file can be left by a hub that was killed
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        server = await asyncio.start_unix_server(self._handle_member, self.path)
+        self._is_hub = True
+        self._connected.set()
+        print(f"Backplane hub listening on {self.path} (pid {os.getpid()})")
+
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_member(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._members.add(writer)
+        try:
+            async for line in reader:
+                data = json.loads(line)
+                self._relay(data["topic"], data["text"])
+        except ConnectionError:
+            pass
+        finally:
+            self._members.discard(writer)
+            writer.close()
+
+    def _relay(self, topic: str, message: str) -> None:
+        self._last_id += 1
+        frame = (
+            json.dumps({"id": self._last_id, "topic": topic, "text": message}).encode()
+            + b"\n"
+        )
+
+        for writer in list(self._members):
+            if writer.transport.get_write_buffer_size() > self.max_buffer_size:
+                # The process doesn't read the messages: the connection is aborted
+                # to free its buffer, and the process connects again
+                print("Backplane member too slow, disconnecting...")
+                self.dropped_members += 1
+                self._members.discard(writer)
+                writer.transport.abort()
+                continue
+            writer.write(frame)
+
+        assert self._deliver is not None
+        self._deliver(self._last_id, topic, message)
+
+    async def _follow_hub(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._hub_writer = writer
+        self._connected.set()
+        try:
+            async for line in reader:
+                data = json.loads(line)
+                # If this process is elected hub later, it continues the sequence
+                self._last_id = data["id"]
+                assert self._deliver is not None
+                self._deliver(data["id"], data["topic"], data["text"])
+        except ConnectionError:
+            pass
+        finally:
+            self._connected.clear()
+            self._hub_writer = None
+            writer.close()
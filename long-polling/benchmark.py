@@ -0,0 +1,179 @@
+"""
+Micro-benchmark for the long-polling MessageManager.
+
+It parks a large number of subscribers, then measures:
+
+- the cost of subscribers leaving and joining while the others stay parked (churn),
+  which is what happens continuously in a real long-polling deployment
+- the latency of publishing a message to a topic without subscribers, and to
+  a topic with all the parked subscribers, and the time needed until every
+  subscriber received it
+- the number of round trips needed by clients to receive a burst of messages,
+  without and with a linger window
+
+Usage:
+    python benchmark.py [subscribers] [churn]
+"""
+import asyncio
+import contextlib
+import gc
+import io
+import json
+import random
+import sys
+import time
+
+from blacksheep import Request
+from blacksheep.contents import ASGIContent
+
+from manager import MessageManager
+
+
+def new_request() -> Request:
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        # Like an ASGI server, send the empty body, then wait until the client
+        # disconnects (never, in this benchmark)
+        if messages:
+            return messages.pop()
+        await asyncio.get_running_loop().create_future()
+
+    request = Request("GET", b"/subscribe", None)
+    request.content = ASGIContent(receive)
+    return request
+
+
+async def park(manager: MessageManager, count: int) -> list[asyncio.Task]:
+    tasks = [
+        asyncio.create_task(manager.subscribe(new_request())) for _ in range(count)
+    ]
+    # Let all subscribers reach their await point
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    return tasks
+
+
+async def churn(
+    manager: MessageManager, victims: list[asyncio.Task]
+) -> list[asyncio.Task]:
+    tasks = []
+    for victim in victims:
+        victim.cancel()
+        tasks.append(asyncio.create_task(manager.subscribe(new_request())))
+        await asyncio.sleep(0)
+    return tasks
+
+
+async def poll(manager: MessageManager, count: int) -> int:
+    """
+    Simulates a client receiving the given number of messages, and returns the
+    number of round trips it needed.
+    """
+    since = manager.last_id
+    round_trips = 0
+    received = 0
+
+    while received < count:
+        response = await manager.subscribe(new_request(), since=since)
+        round_trips += 1
+        assert response.content is not None
+        messages = json.loads(response.content.body)
+        if messages:
+            since = messages[-1]["id"]
+            received += len(messages)
+    return round_trips
+
+
+async def burst(clients: int, messages: int, linger: float) -> None:
+    manager = MessageManager(linger=linger)
+    await manager.start()
+    tasks = [asyncio.create_task(poll(manager, messages)) for _ in range(clients)]
+    await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    for index in range(messages):
+        await manager.add_message(f"Message {index}")
+        # Yield to the event loop, like concurrent /publish requests would do
+        await asyncio.sleep(0)
+
+    round_trips = sum(await asyncio.gather(*tasks))
+    elapsed = time.perf_counter() - started
+    print(
+        f"{'burst':<12} linger={linger * 1000:.0f} ms  {round_trips:>8} round trips  "
+        f"{clients * messages / round_trips:6.1f} messages/response  "
+        f"{elapsed:8.3f} s"
+    )
+
+
+def report(label: str, operations: int, elapsed: float) -> None:
+    print(
+        f"{label:<12} {operations:>8} ops  {elapsed:8.3f} s  "
+        f"{operations / elapsed:>12,.0f} ops/s"
+    )
+
+
+async def main(subscribers: int, operations: int) -> None:
+    manager = MessageManager()
+    await manager.start()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        tasks = await park(manager, subscribers)
+        park_elapsed = time.perf_counter() - started
+
+        # Publishing to another topic does not wake the parked subscribers
+        # (garbage is collected first, not to measure a collection triggered by the
+        # subscribers just created)
+        gc.collect()
+        started = time.perf_counter()
+        await manager.add_message("Hello, World", "quiet")
+        quiet_elapsed = time.perf_counter() - started
+
+    # Pick random victims ahead of time, so that the selection cost does not
+    # pollute the measure
+    random.seed(0)
+    victims = random.sample(tasks, min(operations, len(tasks)))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        tasks.extend(await churn(manager, victims))
+        churn_elapsed = time.perf_counter() - started
+
+        # Let the new subscribers reach their await point
+        await asyncio.sleep(0)
+        parked = len(manager)
+
+        gc.collect()
+        started = time.perf_counter()
+        await manager.add_message("Hello, World")
+        publish_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        deliver_elapsed = time.perf_counter() - started
+
+    report("park", subscribers, park_elapsed)
+    print(f"{'quiet topic':<12} {0:>8} subs  {quiet_elapsed * 1000:8.3f} ms")
+    report("churn", len(victims), churn_elapsed)
+    print(f"{'publish':<12} {parked:>8} subs  {publish_elapsed * 1000:8.3f} ms")
+    report("deliver", parked, deliver_elapsed)
+    assert len(manager) == 0
+
+    latency = manager.stats.delivery_latency.to_dict(1000)
+    print(
+        f"{'latency':<12} p50 {latency['p50']:.3f} ms  p95 {latency['p95']:.3f} ms  "
+        f"p99 {latency['p99']:.3f} ms"
+    )
+
+    await burst(100, 1000, 0)
+    await burst(100, 1000, 0.01)
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        main(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 50_000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 10_000,
+        )
+    )
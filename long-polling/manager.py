@@ -0,0 +1,535 @@
+import asyncio
+import heapq
+import itertools
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Coroutine, Iterable, NamedTuple
+
+from blacksheep import Request, json, no_content
+from blacksheep.contents import ASGIContent
+from blacksheep.exceptions import BadRequest
+
+from backplane import Backplane, LocalBackplane
+from stats import PollingStats
+
+DEFAULT_TOPIC = "default"
+
+_TOPIC_PATTERN = re.compile(r"[\w.\-]{1,100}")
+_WILDCARD_TOPIC_PATTERN = re.compile(r"[\w.\-]{0,100}\*")
+
+
+def check_topic(topic: str, allow_wildcard: bool = False) -> None:
+    """
+    Validates a topic name: topics are created on demand, so their names are
+    restricted to word characters, dots and dashes.
+    """
+    if _TOPIC_PATTERN.fullmatch(topic):
+        return
+    if allow_wildcard and _WILDCARD_TOPIC_PATTERN.fullmatch(topic):
+        return
+    raise BadRequest("Invalid topic name.")
+
+
+@dataclass(slots=True)
+class ActiveRequest:
+    id: int
+    request: Request
+    task: asyncio.Task
+
+
+class LogEntry(NamedTuple):
+    id: int
+    topic: str
+    text: str
+    size: int
+    # Time when the message was published, used to measure delivery latency
+    published_at: float
+
+
+class MessageLog:
+    """
+    Bounded, in-memory log of the messages published to a topic.
+
+    Each message is stored with its sequence id, which clients use as a cursor to
+    resume from the last message they received. The oldest messages are evicted when
+    the log exceeds either the maximum count or the maximum size in bytes.
+    Subscribers read the same message objects from the log: no message is copied per
+    subscriber.
+    """
+
+    def __init__(
+        self, topic: str, max_count: int = 1000, max_bytes: int = 1024 * 1024
+    ) -> None:
+        self.topic = topic
+        self.last_id = 0
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._messages: deque[LogEntry] = deque()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def append(self, message_id: int, message: str) -> None:
+        self.last_id = message_id
+        size = len(message.encode("utf8"))
+        self._messages.append(
+            LogEntry(message_id, self.topic, message, size, time.monotonic())
+        )
+        self._size += size
+
+        # Always keep the last message, even if it exceeds the size limit alone
+        while len(self._messages) > 1 and (
+            len(self._messages) > self.max_count or self._size > self.max_bytes
+        ):
+            self._size -= self._messages.popleft().size
+
+    def get_since(
+        self,
+        since: int,
+        max_count: int | None = None,
+        max_bytes: int | None = None,
+    ) -> list[LogEntry]:
+        """
+        Returns the messages published after the given id that are still in the log,
+        from the oldest to the newest, up to the given count and size in bytes.
+        """
+        # The log is read from the right, since clients are usually close to its end
+        entries = list(
+            itertools.takewhile(
+                lambda entry: entry.id > since, reversed(self._messages)
+            )
+        )
+        entries.reverse()
+        return take_batch(entries, max_count, max_bytes)
+
+    def count_since(self, since: int) -> int:
+        """
+        Returns the number of messages published after the given id that are still
+        in the log.
+        """
+        return sum(
+            1
+            for _ in itertools.takewhile(
+                lambda entry: entry.id > since, reversed(self._messages)
+            )
+        )
+
+
+def take_batch(
+    entries: Iterable[LogEntry],
+    max_count: int | None = None,
+    max_bytes: int | None = None,
+) -> list[LogEntry]:
+    """
+    Returns the first entries fitting in the given count and size in bytes. The first
+    entry is always returned, even if it exceeds the size alone.
+    """
+    batch: list[LogEntry] = []
+    size = 0
+
+    for entry in entries:
+        size += entry.size
+        if batch and (
+            (max_count is not None and len(batch) >= max_count)
+            or (max_bytes is not None and size > max_bytes)
+        ):
+            break
+        batch.append(entry)
+    return batch
+
+
+@dataclass(slots=True)
+class Topic:
+    """
+    A topic, with the log of the messages published to it and its parked
+    subscribers, so that a publish only wakes the subscribers of its topic.
+    """
+
+    name: str
+    log: MessageLog
+    # A set is used instead of asyncio.Event, whose waiters are kept in a deque that
+    # costs O(n) to clean up when a waiting task is cancelled
+    waiters: set[asyncio.Future] = field(default_factory=set)
+    subscribers: int = 0
+    published: int = 0
+    # Messages published since subscribers were last woken up, and the timer used to
+    # wake them up at the end of the linger window
+    pending: int = 0
+    wake_handle: asyncio.TimerHandle | None = None
+
+    @property
+    def lingering(self) -> bool:
+        """
+        Returns a value indicating whether a burst of messages is being collected,
+        before waking parked subscribers.
+        """
+        return self.wake_handle is not None
+
+
+def wake_all(waiters: Iterable[asyncio.Future]) -> None:
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+async def wait_in(waiters: set[asyncio.Future]) -> None:
+    waiter = asyncio.get_running_loop().create_future()
+    waiters.add(waiter)
+    try:
+        await waiter
+    finally:
+        waiters.discard(waiter)
+
+
+class MessageManager:
+    """
+    Keeps track of parked long-polling requests.
+
+    Active requests are indexed by a monotonically increasing id, so that adding
+    and removing a subscriber are O(1) operations regardless of how many requests
+    are parked at the same time.
+
+    Disconnections are detected as soon as the ASGI server notifies them, and the
+    task of the disconnected request is cancelled right away.
+
+    Messages are published to topics, through a backplane which delivers them to all
+    the processes running the application, this one included. Publishing a message
+    appends it to the log of its topic, and wakes in a single step the subscribers
+    of that topic, and those of the wildcard subscriptions matching it: the cost of
+    a publish does not depend on the number of subscribers of other topics.
+    Sequence ids are shared by all topics, so that a single cursor can be used with
+    wildcard subscriptions. Since clients create topics by publishing to them, at
+    most max_topics topics are kept: the least recently used topic without
+    subscribers is removed to make room for a new one.
+
+    When a linger window is configured, parked subscribers are woken up only once
+    the window elapses after the first message of a burst, or as soon as a batch is
+    full, so that they receive the whole burst in a single response. A single timer
+    is used for all the subscribers of a topic.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 60,
+        max_count: int = 1000,
+        max_bytes: int = 1024 * 1024,
+        linger: float = 0,
+        max_batch_count: int = 100,
+        max_batch_bytes: int = 64 * 1024,
+        backplane: Backplane | None = None,
+        max_topics: int = 1000,
+    ) -> None:
+        self.closing = False
+        self.last_id = 0
+        self._active_requests: dict[int, ActiveRequest] = {}
+        self._ids = itertools.count(1)
+        self._topics: dict[str, Topic] = {}
+        self._prefix_waiters: dict[str, set[asyncio.Future]] = {}
+        self._prefix_subscribers: dict[str, int] = {}
+        self._timeout = timeout
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._max_topics = max_topics
+        self._linger = linger
+        self._max_batch_count = max_batch_count
+        self._max_batch_bytes = max_batch_bytes
+        self._backplane = backplane or LocalBackplane()
+        self.stats = PollingStats()
+
+    @property
+    def topics(self) -> dict[str, Topic]:
+        return self._topics
+
+    @property
+    def prefix_subscribers(self) -> dict[str, int]:
+        return self._prefix_subscribers
+
+    @property
+    def backplane(self) -> Backplane:
+        return self._backplane
+
+    async def start(self) -> None:
+        await self._backplane.start(self._deliver)
+
+    async def stop(self) -> None:
+        await self._backplane.stop()
+
+    @property
+    def active_requests(self) -> list[ActiveRequest]:
+        # Return a snapshot, since the registry changes while callers await
+        return list(self._active_requests.values())
+
+    def _get_topic(self, name: str) -> Topic:
+        # Topics are kept from the least to the most recently used
+        topic = self._topics.pop(name, None)
+        if topic is None:
+            if len(self._topics) >= self._max_topics:
+                self._evict_topic()
+            topic = Topic(name, MessageLog(name, self._max_count, self._max_bytes))
+        self._topics[name] = topic
+        return topic
+
+    def _evict_topic(self) -> None:
+        # Topics are created by clients: the least recently used topic without
+        # subscribers is removed, so that the memory used by logs stays bounded
+        for topic in self._topics.values():
+            if not topic.subscribers and not topic.waiters and not topic.lingering:
+                del self._topics[topic.name]
+                self.stats.evicted_topics += 1
+                return
+
+    async def subscribe(
+        self,
+        request: Request,
+        topic: str = DEFAULT_TOPIC,
+        since: int | None = None,
+    ):
+        """
+        Returns the messages published to a topic after the given id. If newer
+        messages are already in the log, they are returned at once, otherwise the
+        request is parked until a message is published or the timeout expires.
+
+        A topic ending with "*" subscribes to all the topics starting with the text
+        before it, for example "news.*"; "*" subscribes to all topics.
+
+        Messages are returned in batches, up to the configured count and size in
+        bytes: clients request the rest passing the id of the last message received.
+
+        Clients that don't specify an id start from the last published message.
+        """
+        check_topic(topic, allow_wildcard=True)
+
+        if since is None or since > self.last_id:
+            # A cursor greater than the last id is issued by a previous instance of
+            # the application: resume from the current position
+            since = self.last_id
+
+        if topic.endswith("*"):
+            return await self._subscribe_prefix(request, topic[:-1], since)
+
+        subscribed_topic = self._get_topic(topic)
+        messages = self._get_batch(subscribed_topic, since)
+        if messages and (
+            len(messages) >= self._max_batch_count or not subscribed_topic.lingering
+        ):
+            return self._messages_response(
+                messages, subscribed_topic.log.count_since(since)
+            )
+
+        subscribed_topic.subscribers += 1
+        try:
+            return await self._park(
+                request, self._wait_for_message(subscribed_topic, since)
+            )
+        finally:
+            subscribed_topic.subscribers -= 1
+            if not subscribed_topic.subscribers and not subscribed_topic.log:
+                # Nothing was ever published to this topic
+                self._topics.pop(topic, None)
+
+    async def _subscribe_prefix(self, request: Request, prefix: str, since: int):
+        messages = self._get_prefix_batch(prefix, since)
+        if messages:
+            return self._messages_response(
+                messages, self._count_prefix_since(prefix, since)
+            )
+
+        self._prefix_subscribers[prefix] = self._prefix_subscribers.get(prefix, 0) + 1
+        try:
+            return await self._park(
+                request, self._wait_for_prefix_message(prefix, since)
+            )
+        finally:
+            self._prefix_subscribers[prefix] -= 1
+            if not self._prefix_subscribers[prefix]:
+                del self._prefix_subscribers[prefix]
+
+    async def _park(self, request: Request, coro: Coroutine):
+        if self.closing:
+            coro.close()
+            return json([])
+
+        parked_at = time.monotonic()
+        task = asyncio.create_task(coro)
+        active_request = ActiveRequest(next(self._ids), request, task)
+        self._active_requests[active_request.id] = active_request
+        watcher = (
+            asyncio.create_task(self.watch_disconnection(active_request))
+            if isinstance(request.content, ASGIContent)
+            else None
+        )
+
+        try:
+            response = await task
+        except asyncio.CancelledError:
+            # Tasks are cancelled when the application stops, or when a request is
+            # disconnected
+            print("Task cancelled...")
+            self.stats.cancellations += 1
+            return no_content()
+        else:
+            return response
+        finally:
+            # The item might have been removed already
+            self._active_requests.pop(active_request.id, None)
+            self.stats.parked_time.observe(time.monotonic() - parked_at)
+            if watcher is not None:
+                watcher.cancel()
+
+    async def watch_disconnection(self, active_request: ActiveRequest):
+        """
+        Waits for the ASGI server to notify that the client went away, and cancels
+        the task of the request. This replaces a periodic sweep calling
+        request.is_disconnected() on every active request: dead connections are
+        released immediately, and parked requests cost nothing while waiting.
+        """
+        assert isinstance(active_request.request.content, ASGIContent)
+        receive = active_request.request.content.receive
+
+        while True:
+            # Long-polling requests have no body: after the empty body, the next
+            # message is sent when the connection is lost
+            message = await receive()
+            if message.get("type") == "http.disconnect":
+                break
+
+        print(f"Request {active_request.id} is disconnected, cancelling its task...")
+        self.stats.disconnects += 1
+        active_request.task.cancel()
+
+    async def _wait_for_message(self, topic: Topic, since: int):
+        try:
+            async with asyncio.timeout(self._timeout):
+                while topic.log.last_id <= since or topic.lingering:
+                    await wait_in(topic.waiters)
+
+                # Note: there is no need to check here if the request is
+                # disconnected, since disconnected requests are cancelled by
+                # watch_disconnection as soon as the client goes away
+                return self._messages_response(
+                    self._get_batch(topic, since), topic.log.count_since(since)
+                )
+        except TimeoutError:
+            # Waited for the timeout period, now closing a Long-Polling request.
+            # The client must create a new request.
+            self.stats.timeouts += 1
+            return json([])
+
+    async def _wait_for_prefix_message(self, prefix: str, since: int):
+        try:
+            async with asyncio.timeout(self._timeout):
+                while True:
+                    # Messages can be published before this task starts waiting
+                    messages = self._get_prefix_batch(prefix, since)
+                    if messages:
+                        return self._messages_response(
+                            messages, self._count_prefix_since(prefix, since)
+                        )
+
+                    waiters = self._prefix_waiters.setdefault(prefix, set())
+                    try:
+                        await wait_in(waiters)
+                    finally:
+                        if not waiters and self._prefix_waiters.get(prefix) is waiters:
+                            del self._prefix_waiters[prefix]
+        except TimeoutError:
+            self.stats.timeouts += 1
+            return json([])
+
+    def _get_batch(self, topic: Topic, since: int) -> list[LogEntry]:
+        return topic.log.get_since(since, self._max_batch_count, self._max_batch_bytes)
+
+    def _get_prefix_batch(self, prefix: str, since: int) -> list[LogEntry]:
+        # Wildcard subscriptions read the logs of all the matching topics, merging
+        # their messages by id
+        return take_batch(
+            heapq.merge(
+                *(
+                    self._get_batch(topic, since)
+                    for topic in self._topics.values()
+                    if topic.name.startswith(prefix)
+                )
+            ),
+            self._max_batch_count,
+            self._max_batch_bytes,
+        )
+
+    def _count_prefix_since(self, prefix: str, since: int) -> int:
+        return sum(
+            topic.log.count_since(since)
+            for topic in self._topics.values()
+            if topic.name.startswith(prefix)
+        )
+
+    def _messages_response(self, messages: list[LogEntry], backlog: int):
+        # The backlog is the number of messages waiting for the subscriber, which
+        # can be more than the batch returned
+        stats = self.stats
+        stats.deliveries += 1
+        stats.delivered.mark(len(messages))
+        stats.batch_size.observe(len(messages))
+        stats.backlog.observe(backlog)
+        # The latency of a batch is the one of its oldest message
+        stats.delivery_latency.observe(time.monotonic() - messages[0].published_at)
+
+        return json(
+            [
+                {"id": entry.id, "topic": entry.topic, "text": entry.text}
+                for entry in messages
+            ]
+        )
+
+    async def add_message(self, message: str, topic: str = DEFAULT_TOPIC) -> None:
+        check_topic(topic)
+        await self._backplane.publish(topic, message)
+
+    def _deliver(self, message_id: int | None, topic_name: str, message: str) -> None:
+        if message_id is None:
+            message_id = self.last_id + 1
+        self.last_id = message_id
+
+        topic = self._get_topic(topic_name)
+        topic.log.append(message_id, message)
+        topic.published += 1
+        topic.pending += 1
+        self.stats.published.mark()
+
+        if self._linger <= 0 or topic.pending >= self._max_batch_count:
+            self._wake(topic)
+        elif topic.wake_handle is None:
+            topic.wake_handle = asyncio.get_running_loop().call_later(
+                self._linger, self._wake, topic
+            )
+
+    def _wake(self, topic: Topic) -> None:
+        if topic.wake_handle is not None:
+            topic.wake_handle.cancel()
+            topic.wake_handle = None
+        topic.pending = 0
+
+        # Swap the waiters before waking them, so that waiters resuming from here on
+        # wait for the next message
+        waiters, topic.waiters = topic.waiters, set()
+        wake_all(waiters)
+
+        if self._prefix_waiters:
+            # Wake the wildcard subscriptions matching the topic
+            for index in range(len(topic.name) + 1):
+                prefix_waiters = self._prefix_waiters.pop(topic.name[:index], None)
+                if prefix_waiters:
+                    wake_all(prefix_waiters)
+
+    def cancel_all_tasks(self):
+        self.closing = True  # Stop processing new requests
+        for item in self._active_requests.values():
+            item.task.cancel()
+
+    def __len__(self):
+        return len(self._active_requests)
@@ -1,8 +1,11 @@
-import asyncio
+import os
 import signal
 from dataclasses import dataclass
 
-from blacksheep import Application, Request, get, json, no_content, ok, post, text
+from blacksheep import Application, Request, get, json, ok, post
+
+from backplane import BackplaneUnavailableError, UnixSocketBackplane
+from manager import DEFAULT_TOPIC, MessageManager
 
 app = Application()
 app.serve_files("static")
@@ -13,103 +16,43 @@ class MessageInput:
     text: str
 
 
-@dataclass(slots=True)
-class ActiveRequest:
-    request: Request
-    task: asyncio.Task
-    queue: asyncio.Queue
-
-
-class MessageManager:
-    def __init__(self) -> None:
-        self.closing = False
-        self._active_requests: list[ActiveRequest] = []
-        self._timeout: float = 60
-
-    @property
-    def active_requests(self) -> list[ActiveRequest]:
-        return self._active_requests
-
-    async def subscribe(self, request: Request):
-        if self.closing:
-            return text("")
-
-        request_queue = asyncio.Queue()
-        task = asyncio.create_task(self.wait_for_message(request, request_queue))
-        active_request = ActiveRequest(request, task, request_queue)
-        self._active_requests.append(active_request)
-
-        try:
-            response = await task
-        except asyncio.CancelledError:
-            # Tasks are cancelled when the application stops, or periodically when
-            # a request is disconnected
-            print("Task cancelled...")
-            return no_content()
-        else:
-            return response
-        finally:
-            try:
-                self._active_requests.remove(active_request)
-            except ValueError:
-                # All is good, the item was already removed
-                pass
-
-    async def wait_for_message(self, request, queue):
-        try:
-            async with asyncio.timeout(self._timeout):
-                message = await queue.get()
-
-                # Note: here it is possible to check if the request is
-                # disconnected using: if await request.is_disconnected()
-                #
-                # This can be useful to avoid consuming operations from this point,
-                # or to cancel tasks.
-                if await request.is_disconnected():
-                    print("🔥🔥🔥 Request is disconnected!")
-                    return
-                return text(message)
-        except TimeoutError:
-            # Waited for the timeout period, now closing a Long-Polling request.
-            # The client must create a new request.
-            return text("")
-
-    async def add_message(self, message):
-        for item in self._active_requests:
-            await item.queue.put(message)
-
-    def cancel_all_tasks(self):
-        self.closing = True  # Stop processing new requests
-        for item in self._active_requests:
-            item.task.cancel()
-
-    def __len__(self):
-        return len(self._active_requests)
-
-
-manager = MessageManager()
-
-
-async def periodic_check():
-    """
-    Periodically checks if active long-polling requests are disconnected, and cancels
-    them if needed.
-    """
-    while True:
-        await asyncio.sleep(5)  # Example: check every 5 seconds
-
-        print("Checking active connections...")
-
-        for item in manager.active_requests:
-            request = item.request
-            if await request.is_disconnected():
-                print(f"Request {id(request)} is disconnected, cancelling its task...")
-                item.task.cancel()
+# Messages are kept in memory, so that clients can resume from the last message they
+# received: the oldest ones are evicted by count, or when exceeding a size in bytes.
+# Parked requests are woken up 20 ms after the first message of a burst (or as soon
+# as a batch is full), to return several messages in a single response.
+manager = MessageManager(
+    timeout=60,
+    max_count=1000,
+    max_bytes=1024 * 1024,
+    linger=0.02,
+    max_batch_count=100,
+    max_batch_bytes=64 * 1024,
+    # Topics are created by clients: the least recently used ones are removed
+    max_topics=1000,
+    # Set the BACKPLANE_SOCKET environment variable to the path of a Unix socket when
+    # running several workers, to spread published messages to all of them
+    backplane=(
+        UnixSocketBackplane(os.environ["BACKPLANE_SOCKET"])
+        if os.environ.get("BACKPLANE_SOCKET")
+        else None
+    ),
+)
 
 
 @app.on_start
-async def start_periodic_check():
-    asyncio.create_task(periodic_check())
+async def start_manager():
+    await manager.start()
+
+
+@app.on_stop
+async def stop_manager():
+    await manager.stop()
+
+
+@app.exception_handler(BackplaneUnavailableError)
+async def backplane_unavailable(app, request, exc: BackplaneUnavailableError):
+    # The hub is being elected, or the workers cannot reach each other
+    return json({"message": str(exc)}, 503)
 
 
 @app.on_start
@@ -127,16 +70,49 @@ async def configure_sigint_handler():
 
 
 @get("/subscribe")
-async def on_subscribe(request):
-    return await manager.subscribe(request)
+async def on_subscribe(request: Request, since: int | None = None):
+    return await manager.subscribe(request, DEFAULT_TOPIC, since)
+
+
+@get("/subscribe/{topic}")
+async def on_subscribe_topic(request: Request, topic: str, since: int | None = None):
+    return await manager.subscribe(request, topic, since)
 
 
 @get("/stats")
 def get_stats():
-    return json({"active_requests": len(manager._active_requests)})
+    return json(
+        {
+            "active_requests": len(manager),
+            "last_id": manager.last_id,
+            **manager.stats.to_dict(),
+            "topics": {
+                topic.name: {
+                    "subscribers": topic.subscribers,
+                    "published": topic.published,
+                    "last_id": topic.log.last_id,
+                    "log_count": len(topic.log),
+                    "log_bytes": topic.log.size,
+                }
+                for topic in manager.topics.values()
+            },
+            "wildcard_subscribers": {
+                prefix + "*": count
+                for prefix, count in manager.prefix_subscribers.items()
+            },
+            "backplane": manager.backplane.info,
+            "pid": os.getpid(),
+        }
+    )
 
 
 @post("/publish")
 async def publish_message(data: MessageInput):
     await manager.add_message(data.text)
     return ok()
+
+
+@post("/publish/{topic}")
+async def publish_topic_message(topic: str, data: MessageInput):
+    await manager.add_message(data.text, topic)
+    return ok()
@@ -24,14 +24,27 @@ function PublishForm(form, url) {
 // Receiving messages with long polling
 function SubscribePane(elem, url) {
 
+    // Id of the last message received, used to resume from it and never miss
+    // messages published between two requests
+    let lastId = null;
+
     function showMessage(message) {
         let messageElem = document.createElement('div');
         messageElem.append(message);
         elem.append(messageElem);
     }
 
+    function getUrl() {
+        // random url parameter to avoid any caching issues
+        let params = new URLSearchParams({ random: Math.random() });
+        if (lastId !== null) {
+            params.set('since', lastId);
+        }
+        return url + '?' + params.toString();
+    }
+
     async function subscribe() {
-        let response = await fetch(url).catch(() => {
+        let response = await fetch(getUrl()).catch(() => {
             // This can happen if the server restarts,
             // we need to try again polling
             setTimeout(() => {
@@ -40,9 +53,12 @@ function SubscribePane(elem, url) {
             return;
         });
 
-        if (response.status == 502) {
-            // Connection timeout
-            // happens when the connection was pending for too long
+        if (!response) {
+            return;
+        }
+
+        if (response.status == 502 || response.status == 204) {
+            // Connection timeout, or the request was cancelled by the server:
             // let's reconnect
             await subscribe();
         } else if (response.status != 200) {
@@ -52,9 +68,12 @@ function SubscribePane(elem, url) {
             await new Promise(resolve => setTimeout(resolve, 1000));
             await subscribe();
         } else {
-            // Got message
-            let message = await response.text();
-            showMessage(message);
+            // Got messages, in a single batch
+            let messages = await response.json();
+            for (let message of messages) {
+                showMessage(message.text);
+                lastId = message.id;
+            }
             await subscribe();
         }
     }
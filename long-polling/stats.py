@@ -0,0 +1,153 @@
+"""
+Runtime statistics for long-polling, updated on the hot path: all structures use a
+fixed amount of memory, and recording a value costs O(1) or O(log(buckets)).
+"""
+
+import bisect
+import math
+import time
+
+
+class Histogram:
+    """
+    Histogram with logarithmic buckets between a minimum and a maximum value, with
+    each bucket bound greater than the previous one by a growth factor. Percentiles
+    are approximated by the upper bound of their bucket, so their relative error is
+    at most the growth factor.
+    """
+
+    __slots__ = ("_bounds", "_counts", "count", "total", "max")
+
+    def __init__(
+        self, minimum: float = 1e-5, maximum: float = 300, growth: float = 1.05
+    ) -> None:
+        buckets = math.ceil(math.log(maximum / minimum, growth)) + 1
+        self._bounds = [minimum * growth**index for index in range(buckets)]
+        # The last bucket counts values greater than the maximum
+        self._counts = [0] * (buckets + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = percentile / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                if index == len(self._bounds):
+                    return self.max
+                return min(self._bounds[index], self.max)
+        return self.max
+
+    def to_dict(self, scale: float = 1) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count * scale if self.count else 0,
+            "p50": self.percentile(50) * scale,
+            "p95": self.percentile(95) * scale,
+            "p99": self.percentile(99) * scale,
+            "max": self.max * scale,
+        }
+
+
+class RateMeter:
+    """
+    Counts events per second over a sliding window, using a ring of one-second
+    slots.
+    """
+
+    __slots__ = ("window", "total", "_counts", "_seconds")
+
+    def __init__(self, window: int = 10) -> None:
+        self.window = window
+        self.total = 0
+        self._counts = [0] * window
+        self._seconds = [0] * window
+
+    def mark(self, count: int = 1) -> None:
+        second = int(time.monotonic())
+        index = second % self.window
+        if self._seconds[index] != second:
+            # The slot was used by a second that is now out of the window
+            self._seconds[index] = second
+            self._counts[index] = 0
+        self._counts[index] += count
+        self.total += count
+
+    def rate(self) -> float:
+        """
+        Returns the average number of events per second, over the last complete
+        seconds of the window.
+        """
+        now = int(time.monotonic())
+        events = sum(
+            count
+            for second, count in zip(self._seconds, self._counts)
+            if now - self.window < second < now
+        )
+        return events / (self.window - 1)
+
+
+class PollingStats:
+    """
+    Statistics of a MessageManager.
+    """
+
+    __slots__ = (
+        "published",
+        "delivered",
+        "deliveries",
+        "timeouts",
+        "cancellations",
+        "disconnects",
+        "evicted_topics",
+        "delivery_latency",
+        "batch_size",
+        "backlog",
+        "parked_time",
+    )
+
+    def __init__(self) -> None:
+        self.published = RateMeter()
+        self.delivered = RateMeter()
+        self.deliveries = 0
+        self.timeouts = 0
+        self.cancellations = 0
+        self.disconnects = 0
+        self.evicted_topics = 0
+        # Time from the publication of a message, to its delivery to a subscriber
+        self.delivery_latency = Histogram()
+        # Number of messages returned in each response, up to the batch limits
+        self.batch_size = Histogram(minimum=1, maximum=10_000, growth=1.25)
+        # Number of messages waiting for a subscriber when a response is returned,
+        # including the ones left for the next requests
+        self.backlog = Histogram(minimum=1, maximum=100_000, growth=1.25)
+        # Time spent by requests waiting for messages
+        self.parked_time = Histogram()
+
+    def to_dict(self) -> dict:
+        return {
+            "published_per_second": self.published.rate(),
+            "delivered_per_second": self.delivered.rate(),
+            "published": self.published.total,
+            "delivered": self.delivered.total,
+            "deliveries": self.deliveries,
+            "timeouts": self.timeouts,
+            "cancellations": self.cancellations,
+            "disconnects": self.disconnects,
+            "evicted_topics": self.evicted_topics,
+            "delivery_latency_ms": self.delivery_latency.to_dict(1000),
+            "batch_size": self.batch_size.to_dict(),
+            "backlog": self.backlog.to_dict(),
+            "parked_time_ms": self.parked_time.to_dict(1000),
+        }
@@ -0,0 +1,737 @@
+"""
+Cache for the responses of upstream servers, following the rules of HTTP caching
+for shared caches (RFC 9111): responses are stored according to their
+Cache-Control, Expires, ETag, and Last-Modified headers, and revalidated with
+conditional requests when they become stale.
+"""
+import asyncio
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Optional
+
+from blacksheep import Request, Response, StreamedContent
+from blacksheep.headers import Headers
+
+HeadersList = list[tuple[bytes, bytes]]
+
+# Sends a request to the upstream server. The headers, when not None, replace the
+# conditional headers of the client (the cache handles them itself)
+Upstream = Callable[[Request, Optional[HeadersList]], Awaitable[Response]]
+
+# Statuses of responses that can be stored without explicit freshness
+# information (RFC 9110, section 15.1)
+CACHEABLE_STATUSES = frozenset({200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501})
+
+# Methods that invalidate the stored responses of their URL (RFC 9111, section 4.4)
+UNSAFE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+
+# Headers of upstream responses that are not stored, or set when responding
+NOT_STORED_HEADERS = frozenset(
+    {
+        b"age",
+        b"connection",
+        b"content-length",
+        b"keep-alive",
+        b"transfer-encoding",
+        b"x-cache",
+    }
+)
+
+# Marks the end of the body in the queue of the client reading a response being
+# stored
+END = None
+
+# Maximum freshness of responses with a Last-Modified header and no explicit
+# freshness, which are fresh for 10% of the time since their last modification
+MAX_HEURISTIC_FRESHNESS = 24 * 3600
+
+Directives = dict[bytes, Optional[bytes]]
+
+
+def parse_cache_control(headers: Headers) -> Directives:
+    directives: Directives = {}
+    for value in headers.get(b"cache-control"):
+        for directive in value.split(b","):
+            name, _, argument = directive.strip().partition(b"=")
+            directives[name.lower()] = argument.strip(b'"') or None
+    return directives
+
+
+def parse_date(value: Optional[bytes]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value.decode()).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_seconds(value: Optional[bytes]) -> Optional[int]:
+    try:
+        return max(int(value), 0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def get_freshness_lifetime(headers: Headers, directives: Directives) -> Optional[float]:
+    """
+    Returns the number of seconds for which a response is fresh, or None if the
+    response doesn't declare it and it cannot be calculated.
+    """
+    if b"no-cache" in directives:
+        return 0
+    for name in (b"s-maxage", b"max-age"):
+        if name in directives:
+            return parse_seconds(directives[name]) or 0
+
+    date = parse_date(headers.get_first(b"date")) or time.time()
+    expires = headers.get_first(b"expires")
+    if expires is not None:
+        # Invalid dates represent a time in the past
+        expires_at = parse_date(expires)
+        return max(expires_at - date, 0) if expires_at else 0
+
+    last_modified = parse_date(headers.get_first(b"last-modified"))
+    if last_modified is not None:
+        return min(max(date - last_modified, 0) / 10, MAX_HEURISTIC_FRESHNESS)
+    return None
+
+
+class CacheEntry:
+    """
+    A stored response, with its body in memory or in a file.
+    """
+
+    __slots__ = (
+        "key",
+        "status",
+        "headers",
+        "body",
+        "path",
+        "size",
+        "stored_at",
+        "expires_at",
+        "etag",
+        "last_modified",
+        "must_revalidate",
+    )
+
+    def __init__(self, key, status: int, headers: Headers) -> None:
+        self.key = key
+        self.status = status
+        self.headers: HeadersList = [
+            (name, value)
+            for name, value in headers
+            if name.lower() not in NOT_STORED_HEADERS
+        ]
+        self.body: Optional[bytes] = None
+        self.path: Optional[str] = None
+        self.size = 0
+        self.stored_at = 0.0
+        self.expires_at = 0.0
+        self.etag = headers.get_first(b"etag")
+        self.last_modified = headers.get_first(b"last-modified")
+        self.must_revalidate = False
+        self.update(headers)
+
+    def update(self, headers: Headers) -> None:
+        directives = parse_cache_control(headers)
+        lifetime = get_freshness_lifetime(headers, directives) or 0
+        # The time when the response was generated, for the Age header
+        self.stored_at = time.time() - (parse_seconds(headers.get_first(b"age")) or 0)
+        self.expires_at = self.stored_at + lifetime
+        self.must_revalidate = (
+            b"must-revalidate" in directives or b"proxy-revalidate" in directives
+        )
+
+    def refresh(self, headers: Headers) -> None:
+        """
+        Updates the entry with the headers of a 304 Not Modified response.
+        """
+        names = {name.lower() for name, _ in headers} - NOT_STORED_HEADERS
+        self.headers = [
+            (name, value) for name, value in self.headers if name.lower() not in names
+        ] + [(name, value) for name, value in headers if name.lower() in names]
+        stored = Headers(self.headers)
+        self.etag = stored.get_first(b"etag")
+        self.last_modified = stored.get_first(b"last-modified")
+        self.update(stored)
+
+    @property
+    def memory_size(self) -> int:
+        return self.size + sum(len(name) + len(value) for name, value in self.headers)
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+    def get_age(self, now: float) -> int:
+        return max(int(now - self.stored_at), 0)
+
+
+class _Sink:
+    """
+    Collects the body of a response being stored: in memory, then in a file when
+    the body is too large to be kept in memory.
+    """
+
+    __slots__ = ("cache", "chunks", "size", "file", "path", "discarded")
+
+    def __init__(self, cache: "HTTPCache") -> None:
+        self.cache = cache
+        self.chunks: list[bytes] = []
+        self.size = 0
+        self.file = None
+        self.path: Optional[str] = None
+        self.discarded = False
+
+    async def write(self, chunk: bytes) -> None:
+        if self.discarded:
+            return
+        self.size += len(chunk)
+        cache = self.cache
+
+        if self.file is None:
+            if self.size <= cache.max_entry_size:
+                self.chunks.append(chunk)
+                return
+            if cache.folder is None or self.size > cache.folder_max_entry_size:
+                self.discard()
+                return
+            # Spill to disk
+            self.path = os.path.join(cache.folder, uuid.uuid4().hex)
+            self.file = await cache.run(open, self.path, "wb")
+            self.chunks.append(chunk)
+            chunk = b"".join(self.chunks)
+            self.chunks.clear()
+        elif self.size > cache.folder_max_entry_size:
+            self.discard()
+            return
+        await cache.run(self.file.write, chunk)
+
+    async def close(self) -> None:
+        if self.file is not None:
+            await self.cache.run(self.file.close)
+
+    def discard(self) -> None:
+        self.discarded = True
+        self.chunks.clear()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None:
+            _remove_file(self.path)
+            self.path = None
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class CacheStats:
+    __slots__ = (
+        "hits",
+        "misses",
+        "revalidated",
+        "stale",
+        "coalesced",
+        "bypassed",
+        "stored",
+        "evicted",
+    )
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.bypassed = 0
+        self.stored = 0
+        self.evicted = 0
+
+
+class HTTPCache:
+    """
+    Cache of the responses to GET requests, in memory, evicting the least recently
+    used entries when the total size of the entries exceeds max_size.
+
+    Bodies larger than max_entry_size are stored in files in a folder, if
+    configured, with their own limit of total size (the folder is emptied when the
+    cache starts and is disposed). Bodies are stored while they are streamed to
+    the client that requested them, by a task that doesn't wait for the client.
+
+    Concurrent requests missing the same entry are coalesced: the first one is
+    sent to the upstream server, the others wait for its response to be stored.
+    Stale entries are revalidated with conditional requests, and are returned if
+    the upstream server fails, unless they must be revalidated.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 64 * 1024 * 1024,
+        max_entry_size: int = 1024 * 1024,
+        folder: Optional[str] = None,
+        folder_max_size: int = 1024 * 1024 * 1024,
+        folder_max_entry_size: int = 100 * 1024 * 1024,
+        coalesce_timeout: float = 30,
+        chunk_size: int = 64 * 1024,
+    ) -> None:
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.folder = folder
+        self.folder_max_size = folder_max_size
+        self.folder_max_entry_size = folder_max_entry_size
+        self.coalesce_timeout = coalesce_timeout
+        self.chunk_size = chunk_size
+        self.stats = CacheStats()
+        self._memory: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self._memory_size = 0
+        self._disk: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self._disk_size = 0
+        # Names of the headers in the Vary header of the responses of each URL,
+        # and keys of the entries of each URL
+        self._vary: dict[bytes, tuple[bytes, ...]] = {}
+        self._keys: dict[bytes, set[tuple]] = {}
+        # Requests sent to the upstream server for a key; their futures are
+        # resolved with True once the response is stored
+        self._pending: dict[tuple, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+
+    async def run(self, function, *args):
+        # File operations run in a thread, not to block the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def _get_key(self, url: bytes, headers: Headers) -> tuple:
+        names = self._vary.get(url)
+        if not names:
+            return (url,)
+        return (url, *(b", ".join(headers.get(name)) for name in names))
+
+    def _get(self, key: tuple) -> Optional[CacheEntry]:
+        for entries in (self._memory, self._disk):
+            entry = entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+                return entry
+        return None
+
+    async def send(self, request: Request, upstream: Upstream) -> Response:
+        """
+        Returns the response to a request from the cache, or from the upstream
+        server.
+        """
+        if request.method != "GET":
+            response = await upstream(request, None)
+            if request.method in UNSAFE_METHODS and response.status < 400:
+                self.invalidate(request.url.value)
+            return response
+
+        directives = parse_cache_control(request.headers)
+        if b"no-store" in directives:
+            self.stats.bypassed += 1
+            return await upstream(request, None)
+        revalidate = b"no-cache" in directives or directives.get(b"max-age") == b"0"
+
+        url = request.url.value
+        key = self._get_key(url, request.headers)
+        entry = self._get(key)
+        if entry is not None and not revalidate and entry.is_fresh(time.time()):
+            self.stats.hits += 1
+            return await self._respond(request, entry, b"HIT")
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await self._wait(request, pending, upstream)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            return await self._fetch(request, key, future, entry, upstream)
+        except BaseException:
+            self._settle(key, future, False)
+            raise
+
+    async def _wait(
+        self, request: Request, pending: asyncio.Future, upstream: Upstream
+    ) -> Response:
+        self.stats.coalesced += 1
+        try:
+            stored = await asyncio.wait_for(
+                asyncio.shield(pending), self.coalesce_timeout
+            )
+        except asyncio.TimeoutError:
+            stored = False
+
+        # The response has just been received or validated, so it is returned even
+        # if it must be revalidated for later requests. The key can be different,
+        # since the Vary header is known now
+        entry = self._get(self._get_key(request.url.value, request.headers))
+        if not stored or entry is None:
+            # The response cannot be shared
+            return await upstream(request, None)
+        return await self._respond(request, entry, b"HIT")
+
+    def _settle(self, key: tuple, future: asyncio.Future, stored: bool) -> None:
+        if self._pending.get(key) is future:
+            del self._pending[key]
+        if not future.done():
+            future.set_result(stored)
+
+    async def _fetch(
+        self,
+        request: Request,
+        key: tuple,
+        future: asyncio.Future,
+        entry: Optional[CacheEntry],
+        upstream: Upstream,
+    ) -> Response:
+        conditional: HeadersList = []
+        if entry is not None:
+            if entry.etag:
+                conditional.append((b"if-none-match", entry.etag))
+            if entry.last_modified:
+                conditional.append((b"if-modified-since", entry.last_modified))
+
+        try:
+            response = await upstream(request, conditional)
+        except Exception:
+            if entry is None or entry.must_revalidate:
+                raise
+            self._settle(key, future, False)
+            self.stats.stale += 1
+            return await self._respond(request, entry, b"STALE")
+
+        if entry is not None:
+            if response.status == 304:
+                entry.refresh(response.headers)
+                self._settle(key, future, True)
+                self.stats.revalidated += 1
+                return await self._respond(request, entry, b"REVALIDATED")
+
+            if response.status >= 500 and not entry.must_revalidate:
+                await response.read()
+                self._settle(key, future, False)
+                self.stats.stale += 1
+                return await self._respond(request, entry, b"STALE")
+
+        self.stats.misses += 1
+        new_entry = self._create_entry(request, response)
+        if new_entry is None:
+            self._settle(key, future, False)
+            response.headers.add(b"x-cache", b"MISS")
+            return response
+
+        if response.content is None:
+            self._store(new_entry)
+            self._settle(key, future, True)
+        else:
+            response = self._tee(new_entry, response, key, future)
+        response.headers.add(b"x-cache", b"MISS")
+        return response
+
+    def _create_entry(
+        self, request: Request, response: Response
+    ) -> Optional[CacheEntry]:
+        """
+        Returns an entry for a response, if it can be stored.
+        """
+        if response.status not in CACHEABLE_STATUSES:
+            return None
+        headers = response.headers
+        directives = parse_cache_control(headers)
+        if (
+            b"no-store" in directives
+            or b"private" in directives
+            or headers.get_first(b"set-cookie") is not None
+        ):
+            return None
+        if request.headers.get_first(b"authorization") is not None and not (
+            b"public" in directives
+            or b"s-maxage" in directives
+            or b"must-revalidate" in directives
+        ):
+            return None
+
+        if response.content is not None and headers.get_first(b"content-type") is None:
+            # The body of the response is not proxied
+            return None
+        size = parse_seconds(headers.get_first(b"content-length"))
+        if size is not None and size > (
+            self.max_entry_size if self.folder is None else self.folder_max_entry_size
+        ):
+            # The body is too large to be stored: coalesced requests don't wait for
+            # it to be downloaded
+            return None
+
+        vary = tuple(
+            name.strip().lower()
+            for value in headers.get(b"vary")
+            for name in value.split(b",")
+        )
+        if b"*" in vary:
+            return None
+        if (
+            get_freshness_lifetime(headers, directives) is None
+            and headers.get_first(b"etag") is None
+        ):
+            return None
+
+        url = request.url.value
+        if vary:
+            self._vary[url] = vary
+        else:
+            self._vary.pop(url, None)
+        return CacheEntry(self._get_key(url, request.headers), response.status, headers)
+
+    def _tee(
+        self,
+        entry: CacheEntry,
+        response: Response,
+        key: tuple,
+        future: asyncio.Future,
+    ) -> Response:
+        """
+        Returns a copy of a response that stores its body while it is streamed.
+        The future is pending under the key of the request, which differs from the
+        key of the entry when the response has a Vary header not known before.
+
+        The body is read from the upstream server by a task, and put in a queue
+        for the client: the coalesced requests don't wait for a slow client. When
+        the body cannot be stored, the rest of it is read as fast as the client
+        reads it.
+        """
+        content = response.content
+        sink = _Sink(self)
+        queue: asyncio.Queue = asyncio.Queue()
+        reading = asyncio.Event()
+        gone = False
+
+        async def read_and_store():
+            stored = False
+            end = END
+            try:
+                async for chunk in content.stream():
+                    await sink.write(chunk)
+                    if gone:
+                        continue
+                    queue.put_nowait(chunk)
+                    if sink.discarded:
+                        # The coalesced requests don't wait for the rest of the body
+                        self._settle(key, future, False)
+                        if not reading.is_set():
+                            try:
+                                await asyncio.wait_for(
+                                    reading.wait(), self.coalesce_timeout
+                                )
+                            except asyncio.TimeoutError:
+                                # The body of the response is never read
+                                break
+                        await queue.join()
+                if not sink.discarded:
+                    await sink.close()
+                    entry.size = sink.size
+                    if sink.path is None:
+                        entry.body = b"".join(sink.chunks)
+                    else:
+                        entry.path = sink.path
+                    stored = self._store(entry)
+            except Exception as error:
+                end = error
+            finally:
+                if not stored:
+                    sink.discard()
+                self._settle(key, future, stored)
+                queue.put_nowait(end)
+
+        async def stream_body():
+            nonlocal gone
+            reading.set()
+            try:
+                while True:
+                    chunk = await queue.get()
+                    queue.task_done()
+                    if chunk is END:
+                        break
+                    if isinstance(chunk, BaseException):
+                        raise chunk
+                    yield chunk
+            finally:
+                # If the client went away, the body is still stored
+                gone = True
+                while not queue.empty():
+                    queue.get_nowait()
+                    queue.task_done()
+
+        task = asyncio.create_task(read_and_store())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return Response(
+            response.status,
+            list(response.headers),
+            StreamedContent(content.type, stream_body),
+        )
+
+    def _store(self, entry: CacheEntry) -> bool:
+        url = entry.key[0]
+        # Removing the entry replaced forgets the Vary header of the URL, if it was
+        # the last entry of the URL
+        vary = self._vary.get(url)
+        self.remove(entry.key)
+        if entry.path is None:
+            size = entry.memory_size
+            if size > self.max_entry_size:
+                return False
+            self._memory[entry.key] = entry
+            self._memory_size += size
+            while self._memory_size > self.max_size:
+                self._remove(self._memory, next(iter(self._memory)))
+                self.stats.evicted += 1
+        else:
+            self._disk[entry.key] = entry
+            self._disk_size += entry.size
+            while self._disk_size > self.folder_max_size:
+                self._remove(self._disk, next(iter(self._disk)))
+                self.stats.evicted += 1
+
+        self.stats.stored += 1
+        if entry.key not in self._memory and entry.key not in self._disk:
+            return False
+        self._keys.setdefault(url, set()).add(entry.key)
+        if vary is not None:
+            self._vary[url] = vary
+        return True
+
+    def _remove(self, entries: OrderedDict, key: tuple) -> None:
+        entry = entries.pop(key)
+        if entry.path is None:
+            self._memory_size -= entry.memory_size
+        else:
+            self._disk_size -= entry.size
+            _remove_file(entry.path)
+
+        keys = self._keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[0]]
+                self._vary.pop(key[0], None)
+
+    def remove(self, key: tuple) -> None:
+        for entries in (self._memory, self._disk):
+            if key in entries:
+                self._remove(entries, key)
+
+    def invalidate(self, url: bytes) -> None:
+        """
+        Removes the entries of a URL.
+        """
+        for key in list(self._keys.get(url, ())):
+            self.remove(key)
+
+    async def _respond(
+        self, request: Request, entry: CacheEntry, status: bytes
+    ) -> Response:
+        now = time.time()
+        headers = entry.headers + [
+            (b"age", str(entry.get_age(now)).encode()),
+            (b"x-cache", status),
+        ]
+
+        if self._is_not_modified(request, entry):
+            return Response(304, headers)
+
+        headers.append((b"content-length", str(entry.size).encode()))
+        content_type = Headers(entry.headers).get_first(b"content-type")
+        if entry.size == 0 or content_type is None:
+            return Response(entry.status, headers)
+
+        if entry.path is None:
+            body = entry.body
+
+            async def read_body():
+                yield body
+
+            return Response(
+                entry.status,
+                headers,
+                StreamedContent(content_type, read_body, entry.size),
+            )
+
+        # The file is opened now: the entry can be evicted while the body is read
+        file = await self.run(open, entry.path, "rb")
+        return Response(
+            entry.status,
+            headers,
+            StreamedContent(content_type, partial(self._read_file, file), entry.size),
+        )
+
+    async def _read_file(self, file):
+        try:
+            while True:
+                chunk = await self.run(file.read, self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            file.close()
+
+    @staticmethod
+    def _is_not_modified(request: Request, entry: CacheEntry) -> bool:
+        if entry.status != 200:
+            return False
+        if_none_match = request.headers.get_first(b"if-none-match")
+        if if_none_match is not None:
+            if entry.etag is None:
+                return False
+            etags = {
+                etag.strip().removeprefix(b"W/") for etag in if_none_match.split(b",")
+            }
+            return b"*" in etags or entry.etag.removeprefix(b"W/") in etags
+
+        if_modified_since = parse_date(request.headers.get_first(b"if-modified-since"))
+        last_modified = parse_date(entry.last_modified)
+        return (
+            if_modified_since is not None
+            and last_modified is not None
+            and last_modified <= if_modified_since
+        )
+
+    def info(self) -> dict:
+        stats = self.stats
+        return {
+            "entries": len(self._memory),
+            "size": self._memory_size,
+            "max_size": self.max_size,
+            "folder_entries": len(self._disk),
+            "folder_size": self._disk_size,
+            "folder_max_size": self.folder_max_size if self.folder else 0,
+            "pending": len(self._pending),
+            "hits": stats.hits,
+            "misses": stats.misses,
+            "revalidated": stats.revalidated,
+            "stale": stats.stale,
+            "coalesced": stats.coalesced,
+            "bypassed": stats.bypassed,
+            "stored": stats.stored,
+            "evicted": stats.evicted,
+        }
+
+    def dispose(self) -> None:
+        self._memory.clear()
+        self._disk.clear()
+        self._memory_size = self._disk_size = 0
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,125 @@
+"""
+Rewrites the headers of proxied requests and responses.
+"""
+from collections.abc import Iterable, Mapping
+
+from blacksheep.headers import Headers
+
+# Headers meaningful only for a single connection, which must not be forwarded by
+# proxies (RFC 7230, section 6.1), including headers used by some clients although
+# not standard (Keep-Alive, Proxy-Connection)
+HOP_BY_HOP_HEADERS = frozenset(
+    {
+        b"connection",
+        b"keep-alive",
+        b"proxy-authenticate",
+        b"proxy-authorization",
+        b"proxy-connection",
+        b"te",
+        b"trailer",
+        b"transfer-encoding",
+        b"upgrade",
+    }
+)
+
+# Values of the Connection header that don't name other headers
+CONNECTION_TOKENS = frozenset({b"keep-alive", b"close"})
+
+# Marks the Connection header in the table of header names: its values are
+# collected while the headers are filtered, then it is removed
+CONNECTION = object()
+
+HeadersList = list[tuple[bytes, bytes]]
+
+
+class HeaderRules:
+    """
+    Rules to rewrite headers, compiled once when the application starts.
+
+    Hop-by-hop headers are always removed, together with the headers named in the
+    Connection header. Other headers can be removed, renamed, or added.
+
+    The action for each header name, as received (in any case), is kept in a
+    table: after the first occurrence of a header name, it is filtered with a
+    single dictionary lookup, without lowercasing it again. The values of the
+    Connection headers are collected in the same pass, and the headers are
+    filtered again only when they contain something else than keep-alive or
+    close.
+    """
+
+    # Header names come from clients: the table does not grow beyond this size
+    max_names = 1000
+
+    def __init__(
+        self,
+        remove: Iterable[bytes] = (),
+        rename: Mapping[bytes, bytes] | None = None,
+        add: Iterable[tuple[bytes, bytes]] = (),
+    ) -> None:
+        self.remove = HOP_BY_HOP_HEADERS | {name.lower() for name in remove}
+        self.rename = {key.lower(): value for key, value in (rename or {}).items()}
+        self.add: HeadersList = list(add)
+        # Name of the header to write for each name received, None to remove it,
+        # or CONNECTION
+        self._names: dict[bytes, bytes | object | None] = {}
+
+    def _compile(self, name: bytes) -> bytes | object | None:
+        lower_name = name.lower()
+        if lower_name == b"connection":
+            target = CONNECTION
+        elif lower_name in self.remove:
+            target = None
+        else:
+            target = self.rename.get(lower_name, name)
+
+        if len(self._names) < self.max_names:
+            self._names[name] = target
+        return target
+
+    def apply(self, headers: Headers) -> HeadersList:
+        """
+        Returns the headers to forward, from the headers of a request or response.
+        """
+        names = self._names
+        result: HeadersList = []
+        # Options can be listed in any of several Connection headers
+        connection: list[bytes] = []
+        try:
+            for key, value in headers:
+                target = names[key]
+                if target is None:
+                    continue
+                if target is CONNECTION:
+                    connection.append(value)
+                    continue
+                result.append((target, value))
+        except KeyError:
+            # Header names seen for the first time
+            result, connection = self._rewrite(headers)
+
+        if connection and any(value not in CONNECTION_TOKENS for value in connection):
+            options = {
+                option.strip().lower()
+                for value in connection
+                for option in value.split(b",")
+            }
+            result, _ = self._rewrite(
+                (key, value) for key, value in headers if key.lower() not in options
+            )
+
+        if self.add:
+            result.extend(self.add)
+        return result
+
+    def _rewrite(
+        self, headers: Iterable[tuple[bytes, bytes]]
+    ) -> tuple[HeadersList, list[bytes]]:
+        result: HeadersList = []
+        connection: list[bytes] = []
+        for key, value in headers:
+            target = self._names[key] if key in self._names else self._compile(key)
+            if target is CONNECTION:
+                connection.append(value)
+            elif target is not None:
+                result.append((target, value))
+        return result, connection
@@ -1,27 +1,113 @@
 import asyncio
+import os
+from functools import partial
+from typing import Optional
 
 import uvicorn
-from blacksheep import Application, Request, Response, StreamedContent
+from blacksheep import Application, Request, Response, StreamedContent, json
 from blacksheep.client import ClientSession
-from blacksheep.client.pool import ClientConnectionPools
 from blacksheep.headers import Headers
 
+from cache import HeadersList, HTTPCache
+from headers import HeaderRules
+from pool import PoolOptions, UpstreamPools
+from singleflight import DEFAULT_VARY, SingleFlight
+from upstreams import BALANCERS, FAILURE_STATUSES, UpstreamGroup
+
 app = Application(show_error_details=True)
 
+# These are the URLs of the applications to which we are proxying, separated by
+# commas: requests are balanced between them
+UPSTREAMS = UpstreamGroup(
+    os.environ.get("PROXY_UPSTREAM", "http://localhost:44777").split(","),
+    BALANCERS[os.environ.get("PROXY_BALANCER", "least-outstanding")](),
+    max_failures=int(os.environ.get("PROXY_MAX_FAILURES", 3)),
+    cooldown=float(os.environ.get("PROXY_COOLDOWN", 10)),
+)
+
+# Options of the pool of connections to the upstream server: opening connections
+# is expensive, so connections are kept open and reused as much as possible
+POOL_OPTIONS = PoolOptions(
+    max_connections=int(os.environ.get("PROXY_POOL_MAX_CONNECTIONS", 100)),
+    max_idle=int(os.environ.get("PROXY_POOL_MAX_IDLE", 100)),
+    idle_timeout=float(os.environ.get("PROXY_POOL_IDLE_TIMEOUT", 4)),
+    max_age=float(os.environ.get("PROXY_POOL_MAX_AGE", 300)),
+    prewarm=int(os.environ.get("PROXY_POOL_PREWARM", 10)),
+)
+
+# Cache of the responses to GET requests, disabled with PROXY_CACHE=0. Bodies
+# larger than PROXY_CACHE_MAX_ENTRY_SIZE are stored in files in PROXY_CACHE_FOLDER,
+# if set
+CACHE = (
+    HTTPCache(
+        max_size=int(os.environ.get("PROXY_CACHE_MAX_SIZE", 64 * 1024 * 1024)),
+        max_entry_size=int(os.environ.get("PROXY_CACHE_MAX_ENTRY_SIZE", 1024 * 1024)),
+        folder=os.environ.get("PROXY_CACHE_FOLDER") or None,
+        folder_max_size=int(
+            os.environ.get("PROXY_CACHE_FOLDER_MAX_SIZE", 1024 * 1024 * 1024)
+        ),
+    )
+    if os.environ.get("PROXY_CACHE", "1") == "1"
+    else None
+)
+
+# Identical concurrent GET and HEAD requests share a single upstream response,
+# disabled with PROXY_SINGLE_FLIGHT=0. Requests are identical if they have the same
+# values for the headers in PROXY_SINGLE_FLIGHT_VARY, separated by commas
+SINGLE_FLIGHT = (
+    SingleFlight(
+        vary=[
+            name.strip().encode()
+            for name in os.environ.get(
+                "PROXY_SINGLE_FLIGHT_VARY", b",".join(DEFAULT_VARY).decode()
+            ).split(",")
+            if name.strip()
+        ]
+    )
+    if os.environ.get("PROXY_SINGLE_FLIGHT", "1") == "1"
+    else None
+)
+
+# Rules to rewrite the headers of proxied requests and responses, compiled once.
+# Hop-by-hop headers are always removed; Content-Type and Content-Length are set by
+# the content of the message.
+REQUEST_HEADERS = HeaderRules(
+    remove=[b"content-type", b"content-length"],
+    add=[(b"via", b"1.1 blacksheep-proxy")],
+)
+# Requests sent by the cache, which handles conditional requests itself
+CACHE_REQUEST_HEADERS = HeaderRules(
+    remove=[
+        b"content-type",
+        b"content-length",
+        b"if-none-match",
+        b"if-modified-since",
+    ],
+    add=[(b"via", b"1.1 blacksheep-proxy")],
+)
+RESPONSE_HEADERS = HeaderRules(
+    remove=[b"date", b"server", b"content-type", b"content-length"],
+    add=[(b"via", b"1.1 blacksheep-proxy")],
+)
+
 
 @app.lifespan
 async def register_http_client():
-    async with ClientSession(
-        # This is the URL of the application to which we are proxying,
-        # set this value in the request handler if you want to support dynamic proxies
-        base_url="http://localhost:44777",
-        pools=ClientConnectionPools(asyncio.get_running_loop()),
-    ) as client:
+    # Each backend has its own pool of connections
+    pools = UpstreamPools(asyncio.get_running_loop(), POOL_OPTIONS)
+    for backend in UPSTREAMS.backends:
+        pools.configure(backend.url, POOL_OPTIONS)
+
+    async with ClientSession(pools=pools) as client:
         print("HTTP client created and registered as singleton")
         app.services.add_instance(client)
+        app.services.add_instance(pools)
+        await pools.prewarm()
         yield
 
     print("HTTP client disposed")
+    if CACHE is not None:
+        CACHE.dispose()
 
 
 def get_content_length(headers: Headers) -> int:
@@ -29,9 +115,12 @@ def get_content_length(headers: Headers) -> int:
     return int(content_length_header) if content_length_header else -1
 
 
-def _get_proxied_request(request: Request) -> Request:
+def _get_proxied_request(
+    request: Request, base_url: str, conditional: Optional[HeadersList] = None
+) -> Request:
     """
     Gets a Request for the destination server, from a request of a source client.
+    Conditional headers, if not None, replace the ones of the client.
 
     Note: the code should probably set X-Forwarded-* headers, and related headers.
     This is left as an exercise!
@@ -52,20 +141,12 @@ def _get_proxied_request(request: Request) -> Request:
             content_length,
         )
     )
-    headers = [
-        (key, value)
-        for key, value in request.headers
-        if key.lower()
-        not in {
-            b"content-type",
-            b"content-length",
-            b"transfer-encoding",
-        }
-    ]
     new_request = Request(
         request.method,
-        request.url.value,
-        headers,
+        base_url.encode() + request.url.value,
+        REQUEST_HEADERS.apply(request.headers)
+        if conditional is None
+        else CACHE_REQUEST_HEADERS.apply(request.headers) + conditional,
     )
 
     return new_request if content is None else new_request.with_content(content)
@@ -84,18 +165,7 @@ def _get_proxied_response(response: Response) -> Response:
             yield chunk
 
     content_type = response.headers.get_first(b"Content-Type")
-    response_headers = [
-        (key, value)
-        for key, value in response.headers
-        if key.lower()
-        not in {
-            b"date",
-            b"server",
-            b"content-type",
-            b"content-length",
-            b"transfer-encoding",
-        }
-    ]
+    response_headers = RESPONSE_HEADERS.apply(response.headers)
 
     content_length = get_content_length(response.headers)
 
@@ -105,7 +175,7 @@ def _get_proxied_response(response: Response) -> Response:
             response_content_reader,
             content_length,
         )
-        if content_type
+        if content_type and response.content is not None
         else None
     )
 
@@ -116,10 +186,68 @@ def _get_proxied_response(response: Response) -> Response:
     )
 
 
+@app.route("/_proxy/pools")
+async def get_pools_stats(pools: UpstreamPools) -> Response:
+    """
+    Returns statistics about the pools of connections to the upstream servers.
+    """
+    return json(pools.info())
+
+
+@app.route("/_proxy/upstreams")
+async def get_upstreams_stats() -> Response:
+    """
+    Returns the state of the upstream servers.
+    """
+    return json(UPSTREAMS.info())
+
+
+@app.route("/_proxy/cache")
+async def get_cache_stats() -> Response:
+    """
+    Returns statistics about the cache.
+    """
+    return json(CACHE.info() if CACHE is not None else None)
+
+
+@app.route("/_proxy/flights")
+async def get_flights_stats() -> Response:
+    """
+    Returns statistics about the requests sharing upstream responses.
+    """
+    return json(SINGLE_FLIGHT.info() if SINGLE_FLIGHT is not None else None)
+
+
+async def send_upstream(
+    http_client: ClientSession,
+    request: Request,
+    conditional: Optional[HeadersList] = None,
+) -> Response:
+    backend = UPSTREAMS.acquire()
+    failed = True
+    try:
+        proxied_request = _get_proxied_request(request, backend.url, conditional)
+        response = await http_client.send(proxied_request)
+        failed = response.status in FAILURE_STATUSES
+    except asyncio.CancelledError:
+        # The client went away, this is not a failure of the backend
+        failed = False
+        raise
+    finally:
+        UPSTREAMS.release(backend, failed)
+    return response
+
+
 @app.route("*", methods="HEAD OPTIONS GET PATCH POST PUT DELETE".split())
 async def proxy_all(request: Request, http_client: ClientSession) -> Response:
-    proxied_request = _get_proxied_request(request)
-    response = await http_client.send(proxied_request)
+    upstream = partial(send_upstream, http_client)
+    if SINGLE_FLIGHT is not None:
+        upstream = partial(SINGLE_FLIGHT.send, upstream=upstream)
+
+    if CACHE is None:
+        response = await upstream(request)
+    else:
+        response = await CACHE.send(request, upstream)
     return _get_proxied_response(response)
 
 
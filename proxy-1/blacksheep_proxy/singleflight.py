@@ -0,0 +1,340 @@
+"""
+Shares the responses of upstream servers between identical concurrent requests
+(single flight), streaming each response to all the requests waiting for it.
+"""
+import asyncio
+from collections.abc import Awaitable, Callable, Iterable
+from functools import partial
+from typing import Optional
+
+from blacksheep import Request, Response, StreamedContent
+
+HeadersList = list[tuple[bytes, bytes]]
+
+Upstream = Callable[[Request, Optional[HeadersList]], Awaitable[Response]]
+
+# Methods of requests that can share a response
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD"})
+
+# Headers of requests that can change the response: requests share a response only
+# if these headers have the same values. Authorization and Cookie keep responses
+# of different users apart
+DEFAULT_VARY = (
+    b"accept",
+    b"accept-encoding",
+    b"accept-language",
+    b"authorization",
+    b"cookie",
+    b"if-modified-since",
+    b"if-none-match",
+    b"range",
+)
+
+# Marks the end of the body in the queues of the requests
+END = None
+
+# Marks the end of the shared body for a request that fell behind the others
+DROPPED = object()
+
+# Headers that must have the same values in the shared response and in the
+# response read by a request that fell behind, to resume the body
+RESUME_HEADERS = (b"content-length", b"etag", b"last-modified")
+
+
+class ResumeError(Exception):
+    """
+    Raised when a request that fell behind a shared response cannot read the rest
+    of the body from a response of its own, because the upstream server returned
+    a different response.
+    """
+
+    def __init__(self) -> None:
+        super().__init__("The shared response could not be resumed.")
+
+
+class Participant:
+    """
+    A request sharing the response of a flight, with the chunks of the body it
+    didn't read yet.
+    """
+
+    __slots__ = ("queue", "size")
+
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.size = 0
+
+
+class Flight:
+    """
+    A request sent to the upstream server, whose response is shared by the
+    identical requests received in the meantime.
+
+    The body is read once from the upstream server, and each chunk is put in the
+    queue of each request. The first chunks are kept, so that requests can join
+    while the body is being read, until their size exceeds a limit.
+    """
+
+    __slots__ = (
+        "key",
+        "ready",
+        "participants",
+        "head",
+        "head_size",
+        "joinable",
+        "done",
+    )
+
+    def __init__(self, key: tuple) -> None:
+        self.key = key
+        # Resolved with the response of the upstream server, or None if the request
+        # sent first was cancelled
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.participants: set[Participant] = set()
+        self.head: list[bytes] = []
+        self.head_size = 0
+        self.joinable = True
+        self.done = False
+
+
+class FlightStats:
+    __slots__ = ("flights", "shared", "fallbacks", "dropped")
+
+    def __init__(self) -> None:
+        self.flights = 0
+        self.shared = 0
+        self.fallbacks = 0
+        self.dropped = 0
+
+
+class SingleFlight:
+    """
+    Sends a single request to the upstream server for identical concurrent
+    requests with an idempotent method, matched by method, URL, and the values of
+    the headers in vary.
+
+    The response is streamed to all the requests while it is read from the
+    upstream server, which is never waited on by a slow client: requests can fall
+    behind by up to max_buffer_size bytes, then they are dropped from the flight
+    and read the rest of the body from a request of their own. Requests received
+    after max_buffer_size bytes of the body have been read are sent to the
+    upstream server.
+    """
+
+    def __init__(
+        self,
+        vary: Iterable[bytes] = DEFAULT_VARY,
+        max_buffer_size: int = 1024 * 1024,
+    ) -> None:
+        self.vary = tuple(name.lower() for name in vary)
+        self.max_buffer_size = max_buffer_size
+        self.stats = FlightStats()
+        self._flights: dict[tuple, Flight] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def _get_key(
+        self, request: Request, conditional: Optional[HeadersList]
+    ) -> Optional[tuple]:
+        if request.method not in IDEMPOTENT_METHODS:
+            return None
+        headers = request.headers
+        if (
+            headers.get_first(b"transfer-encoding") is not None
+            or headers.get_first(b"content-length") not in (None, b"0")
+        ):
+            # Requests with a body
+            return None
+        return (
+            request.method,
+            request.url.value,
+            None if conditional is None else tuple(conditional),
+            *(b", ".join(headers.get(name)) for name in self.vary),
+        )
+
+    async def send(
+        self,
+        request: Request,
+        conditional: Optional[HeadersList] = None,
+        *,
+        upstream: Upstream,
+    ) -> Response:
+        """
+        Returns the response to a request, shared with identical requests.
+        """
+        key = self._get_key(request, conditional)
+        if key is None:
+            return await upstream(request, conditional)
+
+        fetch = partial(upstream, request, conditional)
+        flight = self._flights.get(key)
+        if flight is not None:
+            response = await self._join(flight, fetch)
+            if response is not None:
+                self.stats.shared += 1
+                return response
+            self.stats.fallbacks += 1
+            return await upstream(request, conditional)
+
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.stats.flights += 1
+        try:
+            response = await upstream(request, conditional)
+        except asyncio.CancelledError:
+            # The client went away: the other requests are sent on their own
+            self._close(flight)
+            flight.ready.set_result(None)
+            raise
+        except BaseException as error:
+            self._close(flight)
+            flight.ready.set_exception(error)
+            # Retrieved by the requests that joined, if any
+            flight.ready.exception()
+            raise
+
+        flight.ready.set_result(response)
+        if response.content is None:
+            del self._flights[key]
+            flight.done = True
+        else:
+            task = asyncio.create_task(self._read(flight, response))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return self._participate(flight, response, fetch)
+
+    async def _join(self, flight: Flight, fetch) -> Optional[Response]:
+        response = await asyncio.shield(flight.ready)
+        if response is None or not flight.joinable:
+            return None
+        return self._participate(flight, response, fetch)
+
+    def _participate(self, flight: Flight, response: Response, fetch) -> Response:
+        headers = list(response.headers)
+        if response.content is None:
+            return Response(response.status, headers)
+
+        participant = Participant()
+        if flight.done:
+            participant.queue.put_nowait(END)
+        else:
+            flight.participants.add(participant)
+        return Response(
+            response.status,
+            headers,
+            StreamedContent(
+                response.content.type,
+                partial(
+                    self._stream,
+                    flight,
+                    list(flight.head),
+                    participant,
+                    partial(self._resume, fetch, response),
+                ),
+            ),
+        )
+
+    async def _stream(
+        self,
+        flight: Flight,
+        head: list[bytes],
+        participant: Participant,
+        resume: Callable,
+    ):
+        sent = 0
+        try:
+            for chunk in head:
+                sent += len(chunk)
+                yield chunk
+            while True:
+                chunk = await participant.queue.get()
+                if chunk is END:
+                    break
+                if chunk is DROPPED:
+                    async for chunk in resume(sent):
+                        yield chunk
+                    break
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                participant.size -= len(chunk)
+                sent += len(chunk)
+                yield chunk
+        finally:
+            flight.participants.discard(participant)
+
+    async def _resume(self, fetch, shared: Response, offset: int):
+        # The request fell behind: the body is read again from the upstream server,
+        # skipping the part already sent to the client
+        response = await fetch()
+        if response.content is None:
+            raise ResumeError()
+        if response.status != shared.status or any(
+            response.headers.get_first(name) != shared.headers.get_first(name)
+            for name in RESUME_HEADERS
+        ):
+            # The connection returns to its pool once the body is read
+            async for _ in response.content.stream():
+                pass
+            raise ResumeError()
+
+        async for chunk in response.content.stream():
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            yield chunk[offset:]
+            offset = 0
+
+    def _close(self, flight: Flight) -> None:
+        # No more requests can join
+        flight.joinable = False
+        flight.head = []
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def _put(self, flight: Flight, participant: Participant, chunk: bytes) -> None:
+        # Slow clients don't slow down the others: a request falling behind by more
+        # than max_buffer_size bytes leaves the flight
+        if participant.size and participant.size + len(chunk) > self.max_buffer_size:
+            self.stats.dropped += 1
+            flight.participants.discard(participant)
+            queue = participant.queue
+            while not queue.empty():
+                queue.get_nowait()
+            participant.size = 0
+            queue.put_nowait(DROPPED)
+            return
+        participant.size += len(chunk)
+        participant.queue.put_nowait(chunk)
+
+    async def _read(self, flight: Flight, response: Response) -> None:
+        # The body is read to the end also if all clients went away, so that the
+        # connection can return to its pool
+        end = END
+        try:
+            async for chunk in response.content.stream():
+                if flight.joinable:
+                    flight.head.append(chunk)
+                    flight.head_size += len(chunk)
+                    if flight.head_size > self.max_buffer_size:
+                        self._close(flight)
+                for participant in list(flight.participants):
+                    self._put(flight, participant, chunk)
+        except Exception as error:
+            end = error
+            self._close(flight)
+        finally:
+            # Requests joining now receive the head, then the end
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.done = True
+            for participant in flight.participants:
+                participant.queue.put_nowait(end)
+
+    def info(self) -> dict:
+        stats = self.stats
+        return {
+            "in_flight": len(self._flights),
+            "flights": stats.flights,
+            "shared": stats.shared,
+            "fallbacks": stats.fallbacks,
+            "dropped": stats.dropped,
+        }
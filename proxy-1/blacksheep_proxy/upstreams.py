@@ -0,0 +1,181 @@
+"""
+Groups of upstream servers, with load balancing and passive health checks.
+"""
+import itertools
+import random
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Iterable, Sequence
+
+# Statuses returned by unhealthy servers, or by proxies in front of them
+FAILURE_STATUSES = frozenset({502, 503, 504})
+
+
+class Backend:
+    """
+    An upstream server, with the number of requests waiting for its response.
+    """
+
+    __slots__ = (
+        "url",
+        "outstanding",
+        "requests",
+        "failures",
+        "consecutive_failures",
+        "ejected_until",
+        "ejections",
+    )
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+
+class Balancer(ABC):
+    """
+    Chooses the backend that handles a request, among healthy backends.
+    """
+
+    name: str
+
+    @abstractmethod
+    def choose(self, backends: Sequence[Backend]) -> Backend:
+        ...
+
+
+class RoundRobinBalancer(Balancer):
+    name = "round-robin"
+
+    def __init__(self) -> None:
+        self._counter = itertools.count()
+
+    def choose(self, backends: Sequence[Backend]) -> Backend:
+        return backends[next(self._counter) % len(backends)]
+
+
+class LeastOutstandingBalancer(Balancer):
+    """
+    Chooses the backend with the fewest requests waiting for a response. Ties are
+    broken in turn, otherwise the first backend would get all requests when the
+    load is low.
+    """
+
+    name = "least-outstanding"
+
+    def __init__(self) -> None:
+        self._counter = itertools.count()
+
+    def choose(self, backends: Sequence[Backend]) -> Backend:
+        start = next(self._counter) % len(backends)
+        chosen = backends[start]
+        for backend in itertools.islice(
+            itertools.chain(backends[start:], backends[:start]), 1, None
+        ):
+            if backend.outstanding < chosen.outstanding:
+                chosen = backend
+        return chosen
+
+
+class PowerOfTwoChoicesBalancer(Balancer):
+    """
+    Chooses the backend with fewer outstanding requests between two chosen at
+    random: nearly as good as the least outstanding requests, without looking at
+    every backend, and without sending bursts to the same backend.
+    """
+
+    name = "power-of-two-choices"
+
+    def choose(self, backends: Sequence[Backend]) -> Backend:
+        if len(backends) == 1:
+            return backends[0]
+        first, second = random.sample(backends, 2)
+        return first if first.outstanding <= second.outstanding else second
+
+
+BALANCERS = {
+    balancer.name: balancer
+    for balancer in (
+        RoundRobinBalancer,
+        LeastOutstandingBalancer,
+        PowerOfTwoChoicesBalancer,
+    )
+}
+
+
+class UpstreamGroup:
+    """
+    A group of upstream servers handling the same requests.
+
+    Backends are ejected for a cooldown after max_failures consecutive failures
+    (errors, or responses with the statuses in FAILURE_STATUSES). After the
+    cooldown, a single failure ejects a backend again, a success restores it.
+    If all backends are ejected, requests are sent to all of them, since sending
+    them somewhere is better than failing them all.
+    """
+
+    def __init__(
+        self,
+        urls: Iterable[str],
+        balancer: Balancer,
+        max_failures: int = 3,
+        cooldown: float = 10,
+    ) -> None:
+        self.backends = [Backend(url) for url in urls]
+        if not self.backends:
+            raise ValueError("An upstream group needs at least one backend")
+        self.balancer = balancer
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+    def acquire(self) -> Backend:
+        """
+        Chooses the backend for a request, to be released with release().
+        """
+        now = time.monotonic()
+        backends = [
+            backend for backend in self.backends if not backend.is_ejected(now)
+        ] or self.backends
+        backend = self.balancer.choose(backends)
+        backend.outstanding += 1
+        backend.requests += 1
+        return backend
+
+    def release(self, backend: Backend, failed: bool = False) -> None:
+        backend.outstanding -= 1
+        if not failed:
+            backend.consecutive_failures = 0
+            return
+
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if backend.consecutive_failures >= self.max_failures:
+            now = time.monotonic()
+            if not backend.is_ejected(now):
+                backend.ejections += 1
+                print(f"Ejecting {backend.url} for {self.cooldown} seconds")
+            backend.ejected_until = now + self.cooldown
+
+    def info(self) -> dict:
+        now = time.monotonic()
+        return {
+            "balancer": self.balancer.name,
+            "backends": [
+                {
+                    "url": backend.url,
+                    "healthy": not backend.is_ejected(now),
+                    "outstanding": backend.outstanding,
+                    "requests": backend.requests,
+                    "failures": backend.failures,
+                    "ejections": backend.ejections,
+                }
+                for backend in self.backends
+            ],
+        }
@@ -1,6 +1,8 @@
 """
 Example application to test a proxy implemented with BlackSheep.
 """
+import os
+
 from essentials.folders import ensure_folder
 from flask import Flask, jsonify, request
 from markupsafe import escape
@@ -40,4 +42,4 @@ def upload_files():
 
 
 if __name__ == "__main__":
-    app.run(host="localhost", port=44777, debug=True)
+    app.run(host="localhost", port=int(os.environ.get("APP_PORT", 44777)), debug=True)
@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from blacksheep import Request, Response, StreamedContent
+from blacksheep_proxy.cache import HTTPCache
+
+
+class Upstream:
+    """
+    Fake upstream server, returning the same response to all requests.
+    """
+
+    def __init__(self, headers: list[tuple[bytes, bytes]], *chunks: bytes) -> None:
+        self.headers = [(b"content-type", b"text/plain"), *headers]
+        self.chunks = chunks
+        self.requests = 0
+
+    async def __call__(self, request: Request, conditional) -> Response:
+        self.requests += 1
+        if request.method != "GET":
+            return Response(204, [])
+
+        chunks = self.chunks
+
+        async def read_body():
+            for chunk in chunks:
+                yield chunk
+
+        return Response(
+            200, list(self.headers), StreamedContent(b"text/plain", read_body)
+        )
+
+
+def get(accept: bytes = b"text/plain") -> Request:
+    return Request("GET", b"/items", [(b"accept", accept)])
+
+
+async def send(cache: HTTPCache, request: Request, upstream: Upstream):
+    response = await cache.send(request, upstream)
+    body = await response.read()
+    return response.headers.get_first(b"x-cache"), body
+
+
+@pytest.mark.asyncio
+async def test_response_with_vary_is_cached_again_after_invalidation() -> None:
+    cache = HTTPCache()
+    upstream = Upstream(
+        [(b"cache-control", b"max-age=60"), (b"vary", b"accept")], b"items"
+    )
+
+    assert await send(cache, get(), upstream) == (b"MISS", b"items")
+    assert await send(cache, get(), upstream) == (b"HIT", b"items")
+    assert cache.info()["pending"] == 0
+
+    await cache.send(Request("POST", b"/items", []), upstream)
+
+    assert await send(cache, get(), upstream) == (b"MISS", b"items")
+    assert await send(cache, get(), upstream) == (b"HIT", b"items")
+    assert cache.info()["pending"] == 0
+    assert upstream.requests == 3
+
+
+@pytest.mark.asyncio
+async def test_responses_are_stored_by_vary_header_values() -> None:
+    cache = HTTPCache()
+    upstream = Upstream(
+        [(b"cache-control", b"max-age=60"), (b"vary", b"accept")], b"items"
+    )
+
+    assert await send(cache, get(), upstream) == (b"MISS", b"items")
+    assert await send(cache, get(b"text/html"), upstream) == (b"MISS", b"items")
+    assert await send(cache, get(b"text/html"), upstream) == (b"HIT", b"items")
+    assert cache.info()["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_response_too_large_to_be_stored_is_not_coalesced() -> None:
+    cache = HTTPCache(max_entry_size=4)
+    upstream = Upstream(
+        [(b"cache-control", b"max-age=60"), (b"content-length", b"5")], b"items"
+    )
+
+    response = await cache.send(get(), upstream)
+
+    assert cache.info()["pending"] == 0
+    assert await response.read() == b"items"
+    assert cache.info()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_coalesced_requests_stop_waiting_when_body_is_too_large() -> None:
+    cache = HTTPCache(max_entry_size=4)
+    upstream = Upstream([(b"cache-control", b"max-age=60")], b"items", b"more")
+
+    response = await cache.send(get(), upstream)
+    chunks = response.content.stream()
+
+    assert cache.info()["pending"] == 1
+    assert await chunks.__anext__() == b"items"
+    assert cache.info()["pending"] == 0
+    assert await chunks.__anext__() == b"more"
+
+
+@pytest.mark.asyncio
+async def test_stale_response_with_vary_is_replaced() -> None:
+    cache = HTTPCache()
+    upstream = Upstream(
+        [(b"cache-control", b"max-age=0"), (b"etag", b'"1"'), (b"vary", b"accept")],
+        b"items",
+    )
+
+    assert await send(cache, get(), upstream) == (b"MISS", b"items")
+
+    upstream.headers[1] = (b"cache-control", b"max-age=60")
+    assert await send(cache, get(), upstream) == (b"MISS", b"items")
+    assert await send(cache, get(), upstream) == (b"HIT", b"items")
+    assert upstream.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_coalesced_requests_dont_wait_for_the_first_client() -> None:
+    cache = HTTPCache(coalesce_timeout=5)
+    upstream = Upstream([(b"cache-control", b"max-age=60")], b"items", b"more")
+
+    # The first client doesn't read the body yet
+    response = await cache.send(get(), upstream)
+
+    assert await asyncio.wait_for(send(cache, get(), upstream), 1) == (
+        b"HIT",
+        b"itemsmore",
+    )
+    assert await response.read() == b"itemsmore"
+    assert upstream.requests == 1
+    assert cache.info()["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_response_is_stored_when_the_first_client_goes_away() -> None:
+    cache = HTTPCache()
+    upstream = Upstream([(b"cache-control", b"max-age=60")], b"items", b"more")
+
+    response = await cache.send(get(), upstream)
+    chunks = response.content.stream()
+    assert await chunks.__anext__() == b"items"
+    await chunks.aclose()
+
+    await asyncio.sleep(0)
+    assert await send(cache, get(), upstream) == (b"HIT", b"itemsmore")
+    assert upstream.requests == 1
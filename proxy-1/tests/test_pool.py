@@ -0,0 +1,92 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from blacksheep_proxy.pool import PoolOptions, UpstreamPool
+
+
+@asynccontextmanager
+async def upstream_server():
+    # Accepts connections and keeps them open, like an idle HTTP server
+    writers = []
+
+    async def handle(reader, writer):
+        writers.append(writer)
+        await reader.read()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    try:
+        yield server.sockets[0].getsockname()[1]
+    finally:
+        server.close()
+        for writer in writers:
+            writer.close()
+        await server.wait_closed()
+
+
+@asynccontextmanager
+async def create_pool(**options):
+    async with upstream_server() as port:
+        pool = UpstreamPool(
+            asyncio.get_running_loop(),
+            b"http",
+            b"127.0.0.1",
+            port,
+            options=PoolOptions(**options),
+        )
+        try:
+            yield pool
+        finally:
+            pool.dispose()
+
+
+@pytest.mark.asyncio
+async def test_prewarm_opens_idle_connections() -> None:
+    async with create_pool(max_connections=3) as pool:
+        assert await pool.prewarm(5) == 3
+
+        info = pool.info()
+        assert info["open"] == 3
+        assert info["idle"] == 3
+        assert info["min_idle"] == 3
+
+        connection = await pool.get_connection()
+        assert connection.open
+        assert pool.info()["reused"] == 1
+
+
+@pytest.mark.asyncio
+async def test_sweep_keeps_prewarmed_connections() -> None:
+    async with create_pool(idle_timeout=0.05) as pool:
+        await pool.prewarm(2)
+        connections = [await pool.get_connection() for _ in range(4)]
+        for connection in connections:
+            pool.try_return_connection(connection)
+        assert pool.info()["idle"] == 4
+
+        await asyncio.sleep(0.2)
+
+        info = pool.info()
+        assert info["idle"] == 2
+        assert info["closed_idle"] == 2
+        assert info["created"] == 4
+        assert pool._sweep_handle is None
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_for_a_connection() -> None:
+    async with create_pool(max_connections=1) as pool:
+        connection = await pool.get_connection()
+
+        waiting = asyncio.create_task(pool.get_connection())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        assert pool.info()["waiting"] == 1
+
+        pool.try_return_connection(connection)
+        assert await asyncio.wait_for(waiting, 1) is connection
+
+        info = pool.info()
+        assert info["created"] == 1
+        assert info["saturated"] == 1
+        assert info["waiting"] == 0
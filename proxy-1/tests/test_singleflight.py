@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from blacksheep import Request, Response, StreamedContent
+from blacksheep_proxy.singleflight import ResumeError, SingleFlight
+
+BODY = bytes(index % 251 for index in range(100_000))
+
+
+class Upstream:
+    """
+    Fake upstream server, returning BODY in chunks with the given ETags.
+    """
+
+    def __init__(self, *etags: bytes) -> None:
+        self.etags = etags
+        self.requests = 0
+
+    async def __call__(self, request: Request, conditional) -> Response:
+        etag = self.etags[min(self.requests, len(self.etags) - 1)]
+        self.requests += 1
+        # Lets identical requests join the flight
+        await asyncio.sleep(0.01)
+
+        async def read_body():
+            for index in range(0, len(BODY), 1000):
+                yield BODY[index : index + 1000]
+                await asyncio.sleep(0)
+
+        return Response(
+            200,
+            [(b"content-type", b"text/plain"), (b"etag", etag)],
+            StreamedContent(b"text/plain", read_body),
+        )
+
+
+async def read(response: Response, pause: float = 0) -> bytes:
+    body = b""
+    async for chunk in response.content.stream():
+        body += chunk
+        if pause:
+            # The client stops reading after the first chunk
+            await asyncio.sleep(pause)
+            pause = 0
+    return body
+
+
+async def send_identical_requests(flight: SingleFlight, upstream: Upstream):
+    return await asyncio.gather(
+        *[
+            flight.send(Request("GET", b"/file", []), upstream=upstream)
+            for _ in range(3)
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_slow_client_resumes_the_body_from_the_upstream_server() -> None:
+    flight = SingleFlight(max_buffer_size=10_000)
+    upstream = Upstream(b'"1"')
+    first, second, slow = await send_identical_requests(flight, upstream)
+
+    slow_body = asyncio.create_task(read(slow, pause=0.2))
+
+    # The other clients are not slowed down
+    bodies = await asyncio.wait_for(asyncio.gather(read(first), read(second)), 0.1)
+
+    assert bodies == [BODY, BODY]
+    assert await slow_body == BODY
+    assert flight.info()["dropped"] == 1
+    assert upstream.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_slow_client_cannot_resume_a_different_response() -> None:
+    flight = SingleFlight(max_buffer_size=10_000)
+    upstream = Upstream(b'"1"', b'"2"')
+    first, _, slow = await send_identical_requests(flight, upstream)
+
+    slow_body = asyncio.create_task(read(slow, pause=0.2))
+
+    assert await read(first) == BODY
+    with pytest.raises(ResumeError):
+        await slow_body
@@ -2,6 +2,7 @@
 Example application to test a proxy implemented with BlackSheep.
 This application handles requests from the proxy (defined in blacksheep_proxy).
 """
+import os
 from pathlib import Path
 
 import uvicorn
@@ -47,4 +48,9 @@ async def upload_files(request: Request):
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="localhost", port=44777, lifespan="on")  # , http="h11"
+    uvicorn.run(
+        app,
+        host="localhost",
+        port=int(os.environ.get("APP_PORT", 44777)),
+        lifespan="on",
+    )
@@ -0,0 +1,83 @@
+"""
+Compares the time spent filtering the headers of proxied requests, building a set
+and lowercasing each header name for each request (as done before), and with
+HeaderRules compiled once.
+
+Usage:
+    python blacksheep_proxy/benchmark_headers.py
+"""
+import time
+
+from blacksheep.headers import Headers
+
+from headers import HeaderRules
+
+REQUESTS = 100_000
+
+# Headers sent by a browser
+HEADERS = [
+    (b"Host", b"localhost:44555"),
+    (b"Connection", b"keep-alive"),
+    (b"sec-ch-ua", b'"Chromium";v="124", "Not-A.Brand";v="99"'),
+    (b"sec-ch-ua-mobile", b"?0"),
+    (b"sec-ch-ua-platform", b'"Linux"'),
+    (b"Upgrade-Insecure-Requests", b"1"),
+    (b"User-Agent", b"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"),
+    (b"Accept", b"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"),
+    (b"Sec-Fetch-Site", b"none"),
+    (b"Sec-Fetch-Mode", b"navigate"),
+    (b"Sec-Fetch-User", b"?1"),
+    (b"Sec-Fetch-Dest", b"document"),
+    (b"Accept-Encoding", b"gzip, deflate, br"),
+    (b"Accept-Language", b"en-US,en;q=0.9"),
+    (b"Cookie", b"session=0123456789abcdef"),
+    (b"Content-Type", b"application/json"),
+    (b"Content-Length", b"42"),
+]
+
+
+def filter_with_set(headers):
+    return [
+        (key, value)
+        for key, value in headers
+        if key.lower()
+        not in {
+            b"content-type",
+            b"content-length",
+            b"transfer-encoding",
+        }
+    ]
+
+
+def measure(function, headers) -> float:
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        function(headers)
+    return time.perf_counter() - started
+
+
+def main():
+    rules = HeaderRules(remove=[b"content-type", b"content-length"])
+    headers = Headers(HEADERS)
+    options = Headers(
+        [
+            (key, b"keep-alive, X-Secret" if key == b"Connection" else value)
+            for key, value in HEADERS
+        ]
+        + [(b"X-Secret", b"1")]
+    )
+
+    print(f"{len(HEADERS)} headers per request")
+    print(f"{'filter':>36} {'headers/s':>12}")
+    for name, function, headers in (
+        ("set literal, lower() (before)", filter_with_set, headers),
+        ("HeaderRules", rules.apply, headers),
+        ("HeaderRules, Connection options", rules.apply, options),
+    ):
+        elapsed = measure(function, headers)
+        count = REQUESTS * len(list(headers))
+        print(f"{name:>36} {count / elapsed:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+Connection pools to the upstream servers, with limits, idle timeouts, a maximum
+age for connections, pre-warming, and statistics.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from blacksheep import URL
+from blacksheep.client.connection import ClientConnection
+from blacksheep.client.pool import ConnectionPools, get_ssl_context
+
+logger = logging.getLogger("blacksheep_proxy.pool")
+
+
+@dataclass
+class PoolOptions:
+    """
+    Options of the pool of connections to an upstream server.
+
+    Idle connections must be closed before the upstream server closes them
+    (uvicorn closes idle connections after 5 seconds by default): a request sent
+    on a connection that the server is closing fails and is retried on another.
+    """
+
+    # Connections open at the same time, requests wait for a connection when the
+    # pool is saturated
+    max_connections: int = 100
+    # Connections kept open after use
+    max_idle: int = 100
+    # Seconds after which idle connections are closed
+    idle_timeout: float = 4
+    # Seconds after which connections are not reused, to rebalance connections
+    # when the upstream servers change
+    max_age: float = 300
+    # Connections opened when the application starts, and kept open while idle
+    # unless the upstream server closes them
+    prewarm: int = 0
+
+
+class UpstreamConnection(ClientConnection):
+    """
+    A connection that tells its pool when it is lost, to free its place in the
+    pool, and knows its age.
+    """
+
+    __slots__ = ("created_at", "idle_since")
+
+    def __init__(self, loop, pool) -> None:
+        super().__init__(loop, pool)
+        self.created_at = time.monotonic()
+        self.idle_since = self.created_at
+
+    def connection_lost(self, exc) -> None:
+        super().connection_lost(exc)
+        pool = self.pool()
+        if pool:
+            pool.connection_lost(self)
+
+
+class PoolStats:
+    __slots__ = (
+        "created",
+        "reused",
+        "connect_errors",
+        "connect_time",
+        "connect_time_max",
+        "closed_idle",
+        "closed_expired",
+        "saturated",
+        "wait_time",
+    )
+
+    def __init__(self) -> None:
+        self.created = 0
+        self.reused = 0
+        self.connect_errors = 0
+        self.connect_time = 0.0
+        self.connect_time_max = 0.0
+        self.closed_idle = 0
+        self.closed_expired = 0
+        self.saturated = 0
+        self.wait_time = 0.0
+
+
+class UpstreamPool:
+    """
+    Pool of connections to an upstream server, used by ClientSession like the
+    default ConnectionPool.
+
+    Idle connections are reused last in, first out: the connections used most
+    recently are the ones more likely to be still open, while the others time out.
+    When all connections are in use, requests wait for one to be returned to the
+    pool, or closed.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        scheme: bytes,
+        host: bytes,
+        port: int,
+        ssl=None,
+        options: Optional[PoolOptions] = None,
+    ) -> None:
+        self.loop = loop
+        self.scheme = scheme
+        self.host = host if isinstance(host, str) else host.decode()
+        self.port = int(port)
+        self.ssl = get_ssl_context(scheme, ssl)
+        self.options = options or PoolOptions()
+        self.stats = PoolStats()
+        self.disposed = False
+        self._open: set[UpstreamConnection] = set()
+        self._idle: deque[UpstreamConnection] = deque()
+        # Futures of the requests waiting for a connection, resolved with a
+        # connection returned to the pool, or None when a connection is closed
+        self._waiters: deque[asyncio.Future] = deque()
+        self._connecting = 0
+        self._sweep_handle: Optional[asyncio.TimerHandle] = None
+        # Idle connections not closed after the idle timeout, set by prewarm
+        self._min_idle = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.scheme.decode()}://{self.host}:{self.port}"
+
+    def _is_expired(self, connection: UpstreamConnection, now: float) -> bool:
+        return now - connection.created_at > self.options.max_age
+
+    def _get_connection(self) -> Optional[UpstreamConnection]:
+        now = time.monotonic()
+        self._close_idle(now)
+
+        while self._idle:
+            connection = self._idle.pop()
+            if not connection.open:
+                continue
+            if self._is_expired(connection, now):
+                self.stats.closed_expired += 1
+                connection.close()
+                continue
+            self.stats.reused += 1
+            return connection
+        return None
+
+    async def get_connection(self) -> ClientConnection:
+        connection = self._get_connection()
+        if connection is not None:
+            return connection
+
+        if len(self._open) + self._connecting < self.options.max_connections:
+            return await self.create_connection()
+
+        # The pool is saturated
+        self.stats.saturated += 1
+        started = time.perf_counter()
+        waiter = self.loop.create_future()
+        self._waiters.append(waiter)
+        try:
+            connection = await waiter
+        except asyncio.CancelledError:
+            # The request timed out: don't lose the connection given in between
+            if waiter.done() and not waiter.cancelled():
+                self._give_back(waiter.result())
+            raise
+        finally:
+            self.stats.wait_time += time.perf_counter() - started
+
+        if connection is None:
+            # A connection was closed, a new one can be opened
+            return await self.create_connection()
+        return connection
+
+    async def create_connection(self) -> ClientConnection:
+        logger.debug("Creating connection to: %s:%s", self.host, self.port)
+        self._connecting += 1
+        started = time.perf_counter()
+        try:
+            _, connection = await self.loop.create_connection(
+                lambda: UpstreamConnection(self.loop, self),
+                self.host,
+                self.port,
+                ssl=self.ssl,
+            )
+            await connection.ready.wait()
+        except BaseException:
+            self.stats.connect_errors += 1
+            # Another request can try to connect
+            self._wake(None)
+            raise
+        finally:
+            self._connecting -= 1
+
+        elapsed = time.perf_counter() - started
+        self.stats.created += 1
+        self.stats.connect_time += elapsed
+        self.stats.connect_time_max = max(self.stats.connect_time_max, elapsed)
+        self._open.add(connection)
+        return connection
+
+    def _wake(self, connection: Optional[UpstreamConnection]) -> bool:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return True
+        return False
+
+    def _give_back(self, connection: Optional[UpstreamConnection]) -> None:
+        if connection is None:
+            self._wake(None)
+        else:
+            self.try_return_connection(connection)
+
+    def try_return_connection(self, connection: UpstreamConnection) -> None:
+        if self.disposed:
+            connection.close()
+            return
+
+        now = time.monotonic()
+        if self._is_expired(connection, now):
+            # The connection is closed, and a waiting request will open a new one
+            self.stats.closed_expired += 1
+            connection.close()
+            return
+
+        if self._wake(connection):
+            self.stats.reused += 1
+            return
+
+        if len(self._idle) >= self.options.max_idle:
+            connection.close()
+            return
+
+        connection.idle_since = now
+        self._idle.append(connection)
+        if self._sweep_handle is None:
+            self._sweep_handle = self.loop.call_later(
+                self.options.idle_timeout, self._sweep
+            )
+
+    def connection_lost(self, connection: UpstreamConnection) -> None:
+        if connection not in self._open:
+            return
+        self._open.discard(connection)
+        try:
+            # Closed by the upstream server while idle
+            self._idle.remove(connection)
+        except ValueError:
+            pass
+        if not self.disposed:
+            self._wake(None)
+
+    def _close_idle(self, now: float) -> None:
+        # The connections idle for longer are at the left, the pre-warmed ones are
+        # kept open
+        deadline = now - self.options.idle_timeout
+        while (
+            len(self._idle) > self._min_idle and self._idle[0].idle_since <= deadline
+        ):
+            self.stats.closed_idle += 1
+            self._idle.popleft().close()
+
+    def _sweep(self) -> None:
+        # Closes idle connections also when there are no requests
+        self._sweep_handle = None
+        self._close_idle(time.monotonic())
+        if len(self._idle) > self._min_idle:
+            delay = self._idle[0].idle_since + self.options.idle_timeout
+            self._sweep_handle = self.loop.call_later(
+                max(delay - time.monotonic(), 0), self._sweep
+            )
+
+    async def prewarm(self, count: int) -> int:
+        """
+        Opens connections to the upstream server and keeps them idle, returns the
+        number of connections opened. Up to this number of idle connections are
+        not closed after the idle timeout.
+        """
+        count = min(count, self.options.max_idle, self.options.max_connections)
+        self._min_idle = count
+        results = await asyncio.gather(
+            *[self.create_connection() for _ in range(count)], return_exceptions=True
+        )
+        connections = [item for item in results if isinstance(item, ClientConnection)]
+        for connection in connections:
+            self.try_return_connection(connection)
+
+        if len(connections) < count:
+            logger.warning(
+                "Could not open %s connections to %s",
+                count - len(connections),
+                self.name,
+            )
+        return len(connections)
+
+    def info(self) -> dict:
+        stats = self.stats
+        requests = stats.created + stats.reused
+        return {
+            "upstream": self.name,
+            "max_connections": self.options.max_connections,
+            "open": len(self._open),
+            "in_use": len(self._open) - len(self._idle),
+            "idle": len(self._idle),
+            "min_idle": self._min_idle,
+            "connecting": self._connecting,
+            "waiting": sum(not waiter.done() for waiter in self._waiters),
+            "created": stats.created,
+            "reused": stats.reused,
+            "reuse_ratio": round(stats.reused / requests, 3) if requests else None,
+            "connect_errors": stats.connect_errors,
+            "connect_ms_avg": (
+                round(stats.connect_time / stats.created * 1000, 3)
+                if stats.created
+                else None
+            ),
+            "connect_ms_max": round(stats.connect_time_max * 1000, 3),
+            "closed_idle": stats.closed_idle,
+            "closed_expired": stats.closed_expired,
+            "saturated": stats.saturated,
+            "wait_ms_total": round(stats.wait_time * 1000, 3),
+        }
+
+    def dispose(self) -> None:
+        self.disposed = True
+        if self._sweep_handle is not None:
+            self._sweep_handle.cancel()
+            self._sweep_handle = None
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.cancel()
+        self._waiters.clear()
+        while self._idle:
+            self._idle.pop().close()
+
+
+class UpstreamPools(ConnectionPools):
+    """
+    Pools of connections by upstream server, configured with PoolOptions.
+    """
+
+    def __init__(
+        self,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        options: Optional[PoolOptions] = None,
+    ) -> None:
+        super().__init__(loop)
+        self.options = options or PoolOptions()
+        self._options: dict[tuple[bytes, bytes, int], PoolOptions] = {}
+
+    @staticmethod
+    def _get_key(scheme: bytes, host: bytes, port: Optional[int]):
+        if port is None or port == 0:
+            port = 80 if scheme == b"http" else 443
+        return scheme, host, port
+
+    def configure(self, url: str, options: PoolOptions) -> None:
+        """
+        Sets the options of the pool of connections to an upstream server.
+        """
+        value = URL(url.encode())
+        key = self._get_key(value.schema, value.host, value.port)
+        self._options[key] = options
+
+    def get_pool(self, scheme, host, port, ssl) -> UpstreamPool:
+        assert scheme in (b"http", b"https"), "URL schema must be http or https"
+        key = self._get_key(scheme, host, port)
+        try:
+            return self._pools[key]
+        except KeyError:
+            new_pool = UpstreamPool(
+                self.loop, *key, ssl, self._options.get(key, self.options)
+            )
+            self._pools[key] = new_pool
+            return new_pool
+
+    async def prewarm(self, ssl=None) -> None:
+        """
+        Opens the connections to pre-warm, for the configured upstream servers.
+        """
+        pools = [
+            self.get_pool(*key, ssl)
+            for key, options in self._options.items()
+            if options.prewarm > 0
+        ]
+        for pool, count in zip(
+            pools,
+            await asyncio.gather(
+                *[pool.prewarm(pool.options.prewarm) for pool in pools]
+            ),
+        ):
+            print(f"Opened {count} connections to {pool.name}")
+
+    def info(self) -> list[dict]:
+        return [pool.info() for pool in self._pools.values()]
@@ -0,0 +1,69 @@
+import pytest
+from blacksheep.headers import Headers
+from blacksheep_proxy.headers import HeaderRules
+
+
+def apply_twice(rules: HeaderRules, headers: list[tuple[bytes, bytes]]):
+    # The first time header names are compiled, then they are looked up
+    first = rules.apply(Headers(headers))
+    second = rules.apply(Headers(headers))
+    assert first == second
+    return first
+
+
+def test_hop_by_hop_headers_are_removed() -> None:
+    headers = apply_twice(
+        HeaderRules(),
+        [
+            (b"Host", b"example.com"),
+            (b"Connection", b"keep-alive"),
+            (b"Keep-Alive", b"timeout=5"),
+            (b"Transfer-Encoding", b"chunked"),
+            (b"TE", b"trailers"),
+            (b"Upgrade", b"websocket"),
+            (b"Proxy-Connection", b"keep-alive"),
+            (b"Accept", b"*/*"),
+        ],
+    )
+
+    assert headers == [(b"Host", b"example.com"), (b"Accept", b"*/*")]
+
+
+@pytest.mark.parametrize(
+    "connection",
+    [
+        [(b"Connection", b"X-Secret")],
+        [(b"Connection", b"keep-alive, x-secret")],
+        [(b"connection", b"keep-alive"), (b"CONNECTION", b"X-Secret")],
+    ],
+)
+def test_headers_named_in_connection_are_removed(connection) -> None:
+    headers = apply_twice(
+        HeaderRules(),
+        [(b"Host", b"example.com"), *connection, (b"X-Secret", b"1")],
+    )
+
+    assert headers == [(b"Host", b"example.com")]
+
+
+def test_headers_are_removed_renamed_and_added() -> None:
+    rules = HeaderRules(
+        remove=[b"cookie"],
+        rename={b"X-Forwarded": b"X-Original"},
+        add=[(b"Via", b"1.1 proxy")],
+    )
+
+    headers = apply_twice(
+        rules,
+        [
+            (b"Host", b"example.com"),
+            (b"Cookie", b"session=1"),
+            (b"x-forwarded", b"yes"),
+        ],
+    )
+
+    assert headers == [
+        (b"Host", b"example.com"),
+        (b"X-Original", b"yes"),
+        (b"Via", b"1.1 proxy"),
+    ]
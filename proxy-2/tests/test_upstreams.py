@@ -0,0 +1,124 @@
+import random
+
+import pytest
+from blacksheep_proxy.upstreams import (
+    BALANCERS,
+    Backend,
+    LeastOutstandingBalancer,
+    PowerOfTwoChoicesBalancer,
+    RoundRobinBalancer,
+    UpstreamGroup,
+)
+
+URLS = ["http://a", "http://b", "http://c"]
+
+
+def test_round_robin_balancer() -> None:
+    group = UpstreamGroup(URLS, RoundRobinBalancer())
+
+    chosen = [group.acquire().url for _ in range(6)]
+
+    assert chosen == URLS + URLS
+
+
+def test_least_outstanding_balancer() -> None:
+    group = UpstreamGroup(URLS, LeastOutstandingBalancer())
+    a, b, c = group.backends
+    a.outstanding = 2
+    b.outstanding = 1
+    c.outstanding = 3
+
+    assert group.acquire() is b
+    # b and a have now 2 outstanding requests each: ties are broken in turn
+    assert {group.acquire().url for _ in range(2)} == {"http://a", "http://b"}
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_power_of_two_choices_balancer(seed) -> None:
+    random.seed(seed)
+    backends = [Backend(url) for url in URLS]
+    for outstanding, backend in enumerate(backends):
+        backend.outstanding = outstanding
+
+    # The backend with most outstanding requests loses every comparison
+    assert PowerOfTwoChoicesBalancer().choose(backends) is not backends[2]
+    assert PowerOfTwoChoicesBalancer().choose(backends[:1]) is backends[0]
+
+
+def test_balancers_by_name() -> None:
+    assert set(BALANCERS) == {
+        "round-robin",
+        "least-outstanding",
+        "power-of-two-choices",
+    }
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr("blacksheep_proxy.upstreams.time.monotonic", clock)
+    return clock
+
+
+def send(group: UpstreamGroup, backend: Backend, failed: bool) -> None:
+    backend.outstanding += 1
+    group.release(backend, failed)
+
+
+def test_backend_is_ejected_after_consecutive_failures(clock) -> None:
+    group = UpstreamGroup(URLS, RoundRobinBalancer(), max_failures=2, cooldown=10)
+    a = group.backends[0]
+
+    send(group, a, failed=True)
+    # A success resets the count of consecutive failures
+    send(group, a, failed=False)
+    send(group, a, failed=True)
+    assert a.consecutive_failures == 1
+    assert a.ejections == 0
+
+    send(group, a, failed=True)
+    assert a.ejections == 1
+    assert a.failures == 3
+    assert a.outstanding == 0
+    assert all(group.acquire() is not a for _ in range(6))
+    assert group.info()["backends"][0]["healthy"] is False
+
+
+def test_all_backends_ejected(clock) -> None:
+    group = UpstreamGroup(URLS, RoundRobinBalancer(), max_failures=1)
+    for backend in group.backends:
+        send(group, backend, failed=True)
+
+    # Requests are sent to all backends, rather than failed
+    assert [group.acquire().url for _ in range(3)] == URLS
+
+
+def test_backend_is_restored_after_cooldown(clock) -> None:
+    group = UpstreamGroup(URLS, RoundRobinBalancer(), max_failures=2, cooldown=10)
+    a = group.backends[0]
+    send(group, a, failed=True)
+    send(group, a, failed=True)
+    assert a.ejections == 1
+
+    clock.now += 11
+    assert group.info()["backends"][0]["healthy"] is True
+    assert a in {group.acquire() for _ in range(3)}
+
+    # After the cooldown, a single failure ejects the backend again
+    send(group, a, failed=True)
+    assert a.ejections == 2
+    assert group.info()["backends"][0]["healthy"] is False
+
+    clock.now += 11
+    send(group, a, failed=False)
+    assert a.consecutive_failures == 0
+    send(group, a, failed=True)
+    assert a.ejections == 2
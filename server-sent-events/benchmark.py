@@ -0,0 +1,93 @@
+"""
+Measures how many events per second a single core delivers to clients, when events
+are produced in bursts, writing each event as soon as it is published, or writing
+the events published within a linger window as a single chunk, optionally
+coalesced (latest value wins).
+
+Streams are consumed as the application server does, and each chunk is written to
+/dev/null with a system call, like it would be written to a socket.
+
+Usage:
+    python benchmark.py
+"""
+import asyncio
+import os
+import time
+
+from blacksheep import Request
+
+from hub import EventHub
+
+STREAMS = 1000
+BURSTS = 50
+BURST_SIZE = 20
+
+
+async def consume(hub: EventHub, coalesce: bool, devnull: int, stats: dict) -> None:
+    request = Request("GET", b"/events", [])
+    async for chunk in hub.subscribe(request, coalesce):
+        os.write(devnull, chunk)
+        stats["writes"] += 1
+        stats["events"] += chunk.count(b"\nid: ") + chunk.startswith(b"id: ")
+
+
+async def produce(hub: EventHub) -> None:
+    for burst in range(BURSTS):
+        for i in range(BURST_SIZE):
+            hub.publish({"message": f"Hello World {i}", "burst": burst})
+            # Events of a burst are produced by different tasks, or received from
+            # the network, rather than all at once
+            await asyncio.sleep(0)
+        # Bursts are separated by idle times
+        await asyncio.sleep(0.05)
+
+
+async def measure(linger: float, coalesce: bool) -> tuple[float, dict]:
+    hub = EventHub(linger=linger)
+    stats = {"writes": 0, "events": 0}
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    consumers = [
+        asyncio.create_task(consume(hub, coalesce, devnull, stats))
+        for _ in range(STREAMS)
+    ]
+    await asyncio.sleep(0)
+
+    started = time.process_time()
+    await produce(hub)
+    # Waits for all the streams to write all the events
+    while any(stream.last_id < hub.last_id for stream in hub.streams):
+        await asyncio.sleep(0.01)
+    elapsed = time.process_time() - started
+
+    hub.close()
+    await asyncio.gather(*consumers)
+    os.close(devnull)
+    # The first write of each stream is the retry field
+    stats["writes"] -= STREAMS
+    return elapsed, stats
+
+
+async def main():
+    print(f"{STREAMS:,} streams, {BURSTS} bursts of {BURST_SIZE} events")
+    print(
+        f"{'mode':>22} {'CPU s':>7} {'writes':>10} {'events written':>15} "
+        f"{'published/s':>12} {'deliveries/s':>13}"
+    )
+    published = BURSTS * BURST_SIZE
+    for name, linger, coalesce in (
+        ("write each event", 0, False),
+        ("linger 10 ms", 0.01, False),
+        ("linger 10 ms, coalesce", 0.01, True),
+    ):
+        elapsed, stats = await measure(linger, coalesce)
+        # Coalesced events are delivered too: the client receives the latest value
+        deliveries = published * STREAMS
+        print(
+            f"{name:>22} {elapsed:>7.2f} {stats['writes']:>10,} "
+            f"{stats['events']:>15,} {published / elapsed:>12,.0f} "
+            f"{deliveries / elapsed:>13,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
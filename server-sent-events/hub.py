@@ -0,0 +1,271 @@
+"""
+This module defines a hub producing Server-Sent Events once for all the clients
+connected to the application.
+"""
+import asyncio
+import random
+from collections import deque
+from collections.abc import AsyncIterable
+from itertools import takewhile
+from typing import Any, NamedTuple
+
+from blacksheep import Request
+from blacksheep.contents import ASGIContent
+from blacksheep.scribe import write_sse
+from blacksheep.server.sse import ServerSentEvent, TextServerSentEvent
+
+
+class Event(NamedTuple):
+    id: int
+    # The event field, used to coalesce events of the same type
+    type: str | None
+    # The event in the SSE wire format, sent as-is to all the clients
+    data: bytes
+
+
+def coalesce_events(events: list[Event]) -> list[Event]:
+    """
+    Returns the last event of each type, for streams of state updates where only
+    the latest value matters.
+    """
+    latest = {event.type: event for event in events}
+    return sorted(latest.values())
+
+
+class Stream:
+    """
+    A client receiving events, with the id of the last event it received.
+    """
+
+    __slots__ = ("last_id", "coalesce", "keepalives", "waiter", "closed", "final")
+
+    def __init__(self, last_id: int, coalesce: bool = False, keepalives: int = 0):
+        self.last_id = last_id
+        self.coalesce = coalesce
+        # The last keep-alive tick of the hub at which the stream needs no
+        # keep-alive: the tick following its last write
+        self.keepalives = keepalives
+        self.waiter: asyncio.Future | None = None
+        self.closed = False
+        # Written before ending the stream, when the application is stopping
+        self.final: bytes | None = None
+
+    def close(self, final: bytes | None = None) -> None:
+        self.closed = True
+        self.final = final
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+class EventHub:
+    """
+    Produces each event once, and fans it out to all the connected clients.
+
+    Events are encoded to the SSE wire format once, when published, and kept in a
+    log of the last `max_events` events. Each client follows the log from the last
+    event it received, and waits for new events in a set of futures woken when an
+    event is published: the cost of publishing an event does not depend on the
+    number of clients, except for waking them up.
+
+    Events have ids: clients reconnecting with the Last-Event-ID header receive
+    the events they missed, if still in the log, before the new ones. Clients are
+    told to wait `retry` milliseconds before reconnecting.
+
+    When `linger` is greater than zero, clients are woken up `linger` seconds
+    after an event is published, instead of immediately: all the events published
+    in the meantime are written to each client as a single chunk, which reduces the
+    number of writes when events are produced in bursts. Clients subscribing with
+    `coalesce` receive only the last event of each type among those written
+    together (latest value wins), for streams of state updates.
+
+    Every `keepalive` seconds, a comment is written to the clients that did not
+    receive anything in the meantime, so that proxies don't close idle streams.
+    The keep-alive uses a single timer for all the clients.
+    """
+
+    def __init__(
+        self,
+        max_events: int = 1000,
+        retry: int = 3000,
+        linger: float = 0,
+        keepalive: float = 15,
+    ) -> None:
+        self.last_id = 0
+        self.events: deque[Event] = deque(maxlen=max_events)
+        self.retry = retry
+        self.linger = linger
+        self.keepalive = keepalive
+        self._retry_data = write_sse(TextServerSentEvent("", retry=retry))
+        self._keepalive_data = write_sse(TextServerSentEvent("", comment="keepalive"))
+        self._keepalives = 0
+        self.streams: set[Stream] = set()
+        self._waiters: set[asyncio.Future] = set()
+        self._wake_handle: asyncio.TimerHandle | None = None
+        self._keepalive_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.streams)
+
+    @property
+    def lingering(self) -> bool:
+        return self._wake_handle is not None
+
+    def publish(self, data: Any, event: str | None = None) -> Event:
+        self.last_id += 1
+        published = Event(
+            self.last_id,
+            event,
+            write_sse(ServerSentEvent(data, event=event, id=str(self.last_id))),
+        )
+        self.events.append(published)
+
+        if not self.linger:
+            self._wake()
+        elif self._wake_handle is None:
+            # A single timer for all the clients, started by the first event of
+            # the burst
+            self._wake_handle = asyncio.get_running_loop().call_later(
+                self.linger, self._wake
+            )
+        return published
+
+    def _wake(self) -> None:
+        self._wake_handle = None
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        waiters, self._waiters = self._waiters, set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def get_since(self, last_id: int) -> list[Event]:
+        # Newest events are at the end of the log
+        events = list(
+            takewhile(lambda event: event.id > last_id, reversed(self.events))
+        )
+        events.reverse()
+        return events
+
+    def start(self) -> None:
+        if self.keepalive:
+            self._keepalive_task = asyncio.create_task(self._send_keepalives())
+
+    def close(self) -> None:
+        """Ends all the streams."""
+        self._stop_timers()
+        for stream in list(self.streams):
+            stream.close()
+
+    def drain(self, jitter: int = 10_000) -> None:
+        """
+        Ends all the streams when the application is stopping, telling each client
+        to reconnect after a random delay of up to `jitter` milliseconds more than
+        usual: this way, clients don't all reconnect at the same time when the
+        application restarts.
+        """
+        self._stop_timers()
+        for stream in list(self.streams):
+            retry = self.retry + random.randint(0, jitter)
+            stream.close(write_sse(TextServerSentEvent("", retry=retry)))
+
+    def _stop_timers(self) -> None:
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+            self._wake_handle = None
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+
+    async def _send_keepalives(self) -> None:
+        while True:
+            await asyncio.sleep(self.keepalive)
+            self._keepalives += 1
+            self._wake_waiters()
+
+    def get_last_event_id(self, request: Request) -> int:
+        """
+        Returns the id of the last event received by a client reconnecting, or the
+        id of the last event published for a new client.
+        """
+        value = request.get_first_header(b"Last-Event-ID")
+        try:
+            last_id = int(value) if value else self.last_id
+        except ValueError:
+            return self.last_id
+        # Ids higher than the last one were sent before the application restarted
+        return last_id if 0 <= last_id <= self.last_id else self.last_id
+
+    async def subscribe(
+        self, request: Request, coalesce: bool = False
+    ) -> AsyncIterable[bytes]:
+        """
+        Yields the events published from now on, encoded, until the client
+        disconnects or the hub is closed. Clients reconnecting first receive the
+        events they missed.
+        """
+        stream = Stream(
+            self.get_last_event_id(request), coalesce, self._keepalives + 1
+        )
+        self.streams.add(stream)
+        watcher = (
+            asyncio.create_task(self._watch_disconnection(request, stream))
+            if isinstance(request.content, ASGIContent)
+            else None
+        )
+        try:
+            yield self._retry_data
+
+            while not stream.closed:
+                events = self.get_since(stream.last_id)
+                # Only streams that wrote nothing since the previous tick need a
+                # keep-alive
+                if not events and stream.keepalives < self._keepalives:
+                    stream.keepalives = self._keepalives
+                    yield self._keepalive_data
+                    continue
+
+                # While lingering, clients wait for the end of the burst even if
+                # they have events to write, so that they are written together
+                if not events or self.lingering:
+                    await self._wait(stream)
+                    continue
+
+                stream.last_id = events[-1].id
+                stream.keepalives = self._keepalives + 1
+                if stream.coalesce:
+                    events = coalesce_events(events)
+
+                # All the events not sent yet are written at once: a client
+                # reconnecting receives the events it missed in a single write
+                yield b"".join(event.data for event in events)
+
+            if stream.final is not None:
+                yield stream.final
+        finally:
+            self.streams.discard(stream)
+            if watcher is not None:
+                watcher.cancel()
+
+    async def _wait(self, stream: Stream) -> None:
+        stream.waiter = asyncio.get_running_loop().create_future()
+        self._waiters.add(stream.waiter)
+        try:
+            await stream.waiter
+        finally:
+            self._waiters.discard(stream.waiter)
+            stream.waiter = None
+
+    async def _watch_disconnection(self, request: Request, stream: Stream) -> None:
+        # Waits for the ASGI server to notify that the client went away, instead of
+        # calling request.is_disconnected() for each client at each event
+        assert isinstance(request.content, ASGIContent)
+        receive = request.content.receive
+
+        while True:
+            message = await receive()
+            if message.get("type") == "http.disconnect":
+                break
+
+        print("The request is disconnected!")
+        stream.close()
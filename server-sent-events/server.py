@@ -1,36 +1,72 @@
 import asyncio
 import os
-from collections.abc import AsyncIterable
+from functools import partial
 
-from blacksheep import Application, Request, get
+from blacksheep import Application, Request, Response, get
+from blacksheep.contents import StreamedContent
 from blacksheep.server.process import is_stopping
-from blacksheep.server.sse import ServerSentEvent
+
+from hub import EventHub
+
+# Enable the signal handler to detect when the application is stopping. This must be
+# set before creating the application, which configures the signal handler.
+os.environ["APP_SIGNAL_HANDLER"] = "1"
 
 app = Application(show_error_details=True)
 app.serve_files("static")
 
 
-# Enable the signal handler to detect when the application is stopping.
-os.environ["APP_SIGNAL_HANDLER"] = "1"
+# Events are produced once, and sent to all the connected clients. Events published
+# within 20 ms are written to clients as a single chunk, and idle clients receive a
+# keep-alive comment every 15 seconds.
+hub = EventHub(linger=0.02, keepalive=15)
 
 
-@get("/events")
-async def events_handler(request: Request) -> AsyncIterable[ServerSentEvent]:
+async def produce_events():
     i = 0
 
     while True:
-        if await request.is_disconnected():
-            print("The request is disconnected!")
-            break
+        i += 1
+        hub.publish({"message": f"Hello World {i}"})
 
-        if is_stopping():
-            print("The application is stopping!")
-            break
+        await asyncio.sleep(1)
 
-        i += 1
-        yield ServerSentEvent({"message": f"Hello World {i}"})
 
-        try:
-            await asyncio.sleep(1)
-        except asyncio.exceptions.CancelledError:
-            break
+async def watch_stopping():
+    # The application server waits for the streams to end before stopping: a single
+    # task checks frequently if the application is stopping, and ends all streams
+    while not is_stopping():
+        await asyncio.sleep(0.1)
+
+    print("The application is stopping!")
+    hub.drain()
+
+
+tasks: list[asyncio.Task] = []
+
+
+@app.on_start
+async def start_hub():
+    hub.start()
+    tasks.append(asyncio.create_task(produce_events()))
+    tasks.append(asyncio.create_task(watch_stopping()))
+
+
+@app.on_stop
+async def stop_hub():
+    for task in tasks:
+        task.cancel()
+    hub.close()
+
+
+@get("/events")
+async def events_handler(request: Request, coalesce: bool = False) -> Response:
+    # With ?coalesce=true, only the latest event of each type is written when
+    # several are pending, for clients only interested in the current state
+    return Response(
+        200,
+        [(b"Cache-Control", b"no-cache"), (b"Connection", b"Keep-Alive")],
+        StreamedContent(
+            b"text/event-stream", partial(hub.subscribe, request, coalesce)
+        ),
+    )
@@ -6,6 +6,8 @@
         var element = document.getElementById("message");
         element.innerHTML = event.data;
         console.log("Data:", JSON.parse(event.data));
+        // Sent by the browser in the Last-Event-ID header when reconnecting
+        console.log("Last event id:", event.lastEventId);
     }
 
     eventSource.onerror = function(err) {
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+from blacksheep import Request
+from hub import EventHub
+
+KEEPALIVE = b": keepalive"
+
+
+async def read_stream(hub: EventHub, duration: float) -> list[bytes]:
+    chunks: list[bytes] = []
+
+    async def read():
+        async for chunk in hub.subscribe(Request("GET", b"/events", [])):
+            chunks.append(chunk)
+
+    task = asyncio.create_task(read())
+    await asyncio.sleep(duration)
+    task.cancel()
+    return chunks
+
+
+def count_keepalives(chunks: list[bytes]) -> int:
+    return sum(chunk.startswith(KEEPALIVE) for chunk in chunks)
+
+
+@pytest.mark.asyncio
+async def test_idle_stream_receives_keepalives() -> None:
+    hub = EventHub(keepalive=0.05)
+    hub.start()
+
+    chunks = await read_stream(hub, 0.28)
+    hub.close()
+
+    # Every tick but the first one, after the stream wrote the retry delay
+    assert count_keepalives(chunks) >= 3
+
+
+@pytest.mark.asyncio
+async def test_active_stream_receives_no_keepalives() -> None:
+    hub = EventHub(keepalive=0.05)
+    hub.start()
+
+    async def publish():
+        while True:
+            hub.publish("update")
+            await asyncio.sleep(0.01)
+
+    publisher = asyncio.create_task(publish())
+    chunks = await read_stream(hub, 0.28)
+    publisher.cancel()
+    hub.close()
+
+    assert count_keepalives(chunks) == 0
+    assert len(chunks) > 10
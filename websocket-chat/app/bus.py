@@ -0,0 +1,251 @@
+"""
+Buses spread chat messages to all the processes running the application, so that
+chat rooms work when running several workers:
+
+    uvicorn server:app --workers 4
+
+Each process delivers the messages originated by its clients to its own sockets,
+and publishes them once to the bus; the bus delivers them to the other processes,
+which deliver them only to their own sockets.
+"""
+import asyncio
+import fcntl
+import os
+import random
+import struct
+from abc import ABC, abstractmethod
+from typing import Callable, Optional, Set
+
+# Called with the room and the encoded message published by another process
+DeliverCallback = Callable[[str, bytes], None]
+
+# Frames are exchanged with a header containing the size of the room name and the
+# size of the encoded message, followed by both
+_HEADER = struct.Struct('!HI')
+
+
+class Bus(ABC):
+    @abstractmethod
+    async def start(self, deliver: DeliverCallback) -> None:
+        """Starts the bus, which delivers remote messages using the given callback."""
+
+    @abstractmethod
+    async def publish(self, room: str, data: bytes) -> None:
+        """Publishes a message originated in this process to the other processes."""
+
+    @abstractmethod
+    async def stop(self) -> None:
+        """Stops the bus."""
+
+    def stats(self) -> dict:
+        """Returns statistics about the bus, displayed with the chat statistics."""
+        return {}
+
+
+class LocalBus(Bus):
+    """
+    Bus for a single process: there are no other processes to publish to.
+    """
+
+    async def start(self, deliver: DeliverCallback) -> None:
+        pass
+
+    async def publish(self, room: str, data: bytes) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+def _pack(room: str, data: bytes) -> bytes:
+    room_data = room.encode()
+    return _HEADER.pack(len(room_data), len(data)) + room_data + data
+
+
+async def _read(reader: asyncio.StreamReader) -> Optional[bytes]:
+    try:
+        header = await reader.readexactly(_HEADER.size)
+        room_size, frame_size = _HEADER.unpack(header)
+        return header + await reader.readexactly(room_size + frame_size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def _unpack(data: bytes):
+    room_size, _ = _HEADER.unpack_from(data)
+    room = data[_HEADER.size : _HEADER.size + room_size].decode()
+    return room, data[_HEADER.size + room_size :]
+
+
+class UnixSocketBus(Bus):
+    """
+    Bus for processes running on the same machine, communicating through a Unix
+    socket. It does not require any external service.
+
+    One of the processes acts as hub: it listens on the Unix socket, the other
+    processes connect to it. The hub is elected using an exclusive lock on a file,
+    which the operating system releases when the hub process exits: the other
+    processes then elect a new hub. The hub relays each message to all the other
+    processes, except the one that published it.
+
+    Messages are always delivered to the clients of the process that published
+    them: if no hub can be reached within publish_timeout seconds, they only reach
+    those clients. The hub never waits for a process to read the messages relayed
+    to it: a process with more than max_buffer_size bytes not read yet is
+    disconnected, and connects again.
+    """
+
+    def __init__(
+        self,
+        path: str = '/tmp/blacksheep-chat.sock',
+        publish_timeout: float = 1,
+        max_buffer_size: int = 4 * 1024 * 1024,
+    ) -> None:
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.publish_timeout = publish_timeout
+        self.max_buffer_size = max_buffer_size
+        # Messages that reached only the local clients, and processes disconnected
+        # for being too slow
+        self.unpublished = 0
+        self.dropped_members = 0
+        self._deliver: Optional[DeliverCallback] = None
+        self._is_hub = False
+        self._members: Set[asyncio.StreamWriter] = set()
+        self._hub_writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._lock_file: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: DeliverCallback) -> None:
+        self._deliver = deliver
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        for writer in self._members:
+            writer.close()
+        if self._hub_writer is not None:
+            self._hub_writer.close()
+        if self._lock_file is not None:
+            # Closing the file releases the lock
+            os.close(self._lock_file)
+            self._lock_file = None
+
+    async def publish(self, room: str, data: bytes) -> None:
+        data = _pack(room, data)
+
+        if self._is_hub:
+            self._relay(data, None)
+            return
+
+        try:
+            await asyncio.wait_for(self._send_to_hub(data), self.publish_timeout)
+        except asyncio.TimeoutError:
+            # The message was delivered to the clients of this process only
+            print('The chat bus hub cannot be reached, message not published')
+            self.unpublished += 1
+
+    async def _send_to_hub(self, data: bytes) -> None:
+        await self._connected.wait()
+        assert self._hub_writer is not None
+        self._hub_writer.write(data)
+        await self._hub_writer.drain()
+
+    def stats(self) -> dict:
+        return {
+            'bus_unpublished': self.unpublished,
+            'bus_dropped_members': self.dropped_members,
+        }
+
+    def _try_acquire_lock(self) -> bool:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_file = fd
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            if self._try_acquire_lock():
+                await self._serve()
+                return
+
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The hub is starting, or was just elected
+                await asyncio.sleep(0.1)
+                continue
+
+            await self._follow_hub(reader, writer)
+
+            # The hub went away: wait a random time before electing a new one, so
+            # that the other processes don't all compete at the same instant
+            await asyncio.sleep(random.uniform(0, 0.2))
+
+    async def _serve(self) -> None:
+        # The socket file can be left by a hub that was killed
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        server = await asyncio.start_unix_server(self._handle_member, self.path)
+        self._is_hub = True
+        self._connected.set()
+        print(f'Chat bus hub listening on {self.path} (pid {os.getpid()})')
+
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_member(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._members.add(writer)
+        try:
+            while True:
+                data = await _read(reader)
+                if data is None:
+                    break
+                self._relay(data, writer)
+                self._deliver_remote(data)
+        finally:
+            self._members.discard(writer)
+            writer.close()
+
+    def _relay(self, data: bytes, origin: Optional[asyncio.StreamWriter]) -> None:
+        for writer in list(self._members):
+            if writer is origin:
+                continue
+            if writer.transport.get_write_buffer_size() > self.max_buffer_size:
+                # The process doesn't read the messages: the connection is aborted
+                # to free its buffer, and the process connects again
+                print('Chat bus member too slow, disconnecting...')
+                self.dropped_members += 1
+                self._members.discard(writer)
+                writer.transport.abort()
+                continue
+            writer.write(data)
+
+    def _deliver_remote(self, data: bytes) -> None:
+        assert self._deliver is not None
+        self._deliver(*_unpack(data))
+
+    async def _follow_hub(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._hub_writer = writer
+        self._connected.set()
+        try:
+            while True:
+                data = await _read(reader)
+                if data is None:
+                    break
+                self._deliver_remote(data)
+        finally:
+            self._connected.clear()
+            self._hub_writer = None
+            writer.close()
@@ -1,47 +1,339 @@
+import asyncio
 from datetime import datetime
-from typing import List
+from enum import Enum
+from typing import Dict, Optional, Set
 
 from blacksheep import WebSocket
+from blacksheep.server.websocket import WebSocketError
+from .bus import Bus, LocalBus
+from .history import Histories
 from .message import Message
+from .protocols import BINARY, JSON, Frame, Protocol, negotiate
+from .ratelimit import TokenBucket
+from .timers import TimerWheel
+
+DEFAULT_ROOM = 'lobby'
+
+
+class OverflowPolicy(Enum):
+    """
+    What to do with a message for a connection that fell behind, when its outbound
+    queue is full.
+    """
+
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    DISCONNECT = 'disconnect'
 
 
 class Connection:
-    def __init__(self, socket: WebSocket, client_id: str):
+    """
+    A client connected through a WebSocket.
+
+    Outbound messages are put in a bounded queue, drained by a writer task owned by
+    the connection: sending a message to a client never waits for the client to
+    receive it, so a slow client does not delay the others. Messages are queued
+    already encoded with the protocol negotiated by the client.
+
+    Inbound messages are limited by a token bucket: a client sending messages
+    faster than allowed is throttled.
+    """
+
+    def __init__(
+        self,
+        socket: WebSocket,
+        client_id: str,
+        room: str = DEFAULT_ROOM,
+        max_queue_size: int = 100,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        protocol: Protocol = JSON,
+        max_rate: float = 10,
+        burst: int = 20,
+    ):
         self.socket = socket
         self.client_id = client_id
+        self.room = room
+        self.overflow_policy = overflow_policy
+        self.protocol = protocol
+        self.bucket = TokenBucket(max_rate, burst)
+        self.dropped = 0
+        self.throttled = 0
+        self.missed_heartbeats = 0
+        self._queue: asyncio.Queue[Frame] = asyncio.Queue(max_queue_size)
+        self._writer: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write())
+
+    def stop(self):
+        if self._writer is not None:
+            self._writer.cancel()
 
     async def receive(self) -> Message:
-        data = await self.socket.receive_json()
-        message = Message(**data)
-        return message
+        while True:
+            message = await self.protocol.receive(self.socket)
+            # Any frame shows that the client is alive
+            self.missed_heartbeats = 0
+            if message is not None:
+                return message
 
-    async def send(self, message: Message):
-        await self.socket.send_json(message.asdict())
+    async def send(self, frame: Frame):
+        await self.protocol.send(self.socket, frame)
+
+    def enqueue(self, frame: Frame):
+        """
+        Puts an encoded message in the outbound queue of the connection, applying
+        the overflow policy if the client fell behind.
+        """
+        if self._closing is not None:
+            return
+
+        try:
+            self._queue.put_nowait(frame)
+            return
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+        if self.overflow_policy is OverflowPolicy.DROP_OLDEST:
+            self._queue.get_nowait()
+            self._queue.put_nowait(frame)
+        elif self.overflow_policy is OverflowPolicy.DISCONNECT:
+            print(f'{self.client_id} is too slow, disconnecting...')
+            self.stop()
+            # 1013: Try Again Later
+            self._closing = asyncio.create_task(
+                self.socket.close(1013, 'Too slow to receive messages')
+            )
+
+    async def _write(self):
+        while True:
+            frame = await self._queue.get()
+            try:
+                await self.send(frame)
+            except (WebSocketError, OSError):
+                # The client disconnected: the connection manager is notified by
+                # the reading side, and removes the connection
+                break
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[Connection] = []
+    """
+    Keeps track of the connections of each chat room.
+
+    Rooms are sets of connections indexed by name: joining, leaving, and
+    broadcasting to a room cost in proportion to the size of the room, not to the
+    total number of connections. Rooms are created when the first client joins,
+    and removed when the last client leaves.
+
+    When running several processes, the bus delivers the messages broadcast by the
+    other processes to the connections of this process.
+
+    Each client can send up to `max_rate` messages per second (with bursts of
+    `burst` messages), and all clients together can cause up to `broadcast_budget`
+    deliveries per second (a message broadcast to a room of 100 clients costs 100).
+    Over the limits, messages of the client are not read until the client is back
+    within its rate: the client is throttled by the flow control of WebSocket and
+    TCP, instead of having its messages buffered without bounds.
+
+    Clients are sent a heartbeat every `heartbeat_interval` seconds, and are
+    disconnected after missing `max_missed_heartbeats` heartbeats in a row: this
+    removes clients whose connection was lost without being closed.
+
+    The last messages of each room are kept in a history: clients joining a room
+    receive the last `history_size` messages, and clients reconnecting receive the
+    messages after the last one they received.
+    """
 
-    async def connect(self, websocket: WebSocket, client_id: str) -> Connection:
-        await websocket.accept()
-        connection = Connection(websocket, client_id)
+    def __init__(
+        self,
+        max_queue_size: int = 100,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        bus: Optional[Bus] = None,
+        max_rate: float = 10,
+        burst: int = 20,
+        broadcast_budget: float = 100_000,
+        heartbeat_interval: float = 30,
+        max_missed_heartbeats: int = 2,
+        history_size: int = 50,
+        history_max_count: int = 100,
+        history_max_bytes: int = 64 * 1024,
+    ):
+        self.rooms: Dict[str, Set[Connection]] = {}
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.bus = bus or LocalBus()
+        self.max_rate = max_rate
+        self.burst = burst
+        self.budget = TokenBucket(broadcast_budget, broadcast_budget)
+        # Number of times clients were throttled for exceeding their rate, and
+        # broadcasts were delayed for exceeding the global budget
+        self.throttled = 0
+        self.budget_exceeded = 0
+        self.max_missed_heartbeats = max_missed_heartbeats
+        self.heartbeats: TimerWheel[Connection] = TimerWheel(
+            heartbeat_interval, self.heartbeat
+        )
+        self.evicted = 0
+        # The event loop keeps only weak references to tasks
+        self._evictions: Set[asyncio.Task] = set()
+        self.history_size = history_size
+        self.histories = Histories(
+            max_count=history_max_count, max_bytes=history_max_bytes
+        )
+
+    async def start(self):
+        self.heartbeats.start()
+        await self.bus.start(self.deliver_remote)
+
+    async def stop(self):
+        self.heartbeats.stop()
+        await self.bus.stop()
+
+    def __len__(self):
+        return sum(len(connections) for connections in self.rooms.values())
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        client_id: str,
+        room: str = DEFAULT_ROOM,
+        since: Optional[int] = None,
+    ) -> Connection:
+        protocol, subprotocol = negotiate(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(
+            websocket,
+            client_id,
+            room,
+            self.max_queue_size,
+            self.overflow_policy,
+            protocol,
+            self.max_rate,
+            self.burst,
+        )
+        connection.start()
         await self.greet(connection)
-        self.active_connections.append(connection)
+        # The history is sent right before joining the room, so that the client
+        # does not miss messages in between
+        self.catch_up(connection, since)
+        self.rooms.setdefault(room, set()).add(connection)
+        self.heartbeats.add(connection)
         return connection
 
+    def catch_up(self, connection: Connection, since: Optional[int] = None):
+        """
+        Sends to a client the last messages of its room in a single frame, or the
+        messages after the given id if the client is reconnecting.
+        """
+        entries = self.histories[connection.room].get(self.history_size, since)
+        if entries:
+            protocol = connection.protocol
+            connection.enqueue(
+                protocol.batch([entry.frame(protocol) for entry in entries])
+            )
+
     async def disconnect(self, connection: Connection):
-        self.active_connections.remove(connection)
+        connections = self.rooms.get(connection.room)
+        if connections is None or connection not in connections:
+            # Already disconnected, for example after missing heartbeats
+            return
+        connections.discard(connection)
+        if not connections:
+            del self.rooms[connection.room]
+        self.heartbeats.remove(connection)
+        connection.stop()
         await self.bye(connection)
 
+    def heartbeat(self, connection: Connection):
+        if connection.missed_heartbeats >= self.max_missed_heartbeats:
+            self.heartbeats.remove(connection)
+            task = asyncio.create_task(self.evict(connection))
+            self._evictions.add(task)
+            task.add_done_callback(self._eviction_done)
+            return
+        # Reset when any frame is received from the client
+        connection.missed_heartbeats += 1
+        connection.enqueue(connection.protocol.ping)
+
+    def _eviction_done(self, task: asyncio.Task):
+        self._evictions.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f'Failed to evict a connection: {task.exception()!r}')
+
+    async def evict(self, connection: Connection):
+        print(f'{connection.client_id} missed heartbeats, disconnecting...')
+        self.evicted += 1
+        await self.disconnect(connection)
+        try:
+            await connection.socket.close(1001, 'Missed heartbeats')
+        except (WebSocketError, OSError):
+            pass
+
     async def manage(self, connection: Connection):
+        delay = connection.bucket.take()
+        if delay:
+            connection.throttled += 1
+            self.throttled += 1
+            await asyncio.sleep(delay)
+
         message = await connection.receive()
-        await self.broadcast(message)
 
-    async def broadcast(self, message: Message):
-        print('Broadcast to %s connections' % len(self.active_connections))
-        for connection in self.active_connections:
-            await connection.send(message)
+        delay = self.budget.take(len(self.rooms.get(connection.room, ())))
+        if delay:
+            self.budget_exceeded += 1
+            await asyncio.sleep(delay)
+
+        await self.broadcast(message, connection.room)
+
+    def stats(self) -> dict:
+        connections = [
+            connection
+            for connections in self.rooms.values()
+            for connection in connections
+        ]
+        return {
+            'connections': len(connections),
+            'rooms': len(self.rooms),
+            'throttled': self.throttled,
+            'throttled_clients': sum(
+                1 for connection in connections if connection.throttled
+            ),
+            'budget_exceeded': self.budget_exceeded,
+            'evicted': self.evicted,
+            'dropped': sum(connection.dropped for connection in connections),
+            **self.bus.stats(),
+        }
+
+    async def broadcast(self, message: Message, room: str = DEFAULT_ROOM):
+        message.id = self.histories[room].next_id()
+        data = BINARY.encode(message)
+        self.deliver(room, message, data)
+        await self.bus.publish(room, data)
+
+    def deliver(self, room: str, message: Message, data: bytes):
+        """
+        Sends a message to the connections of a room in this process, and adds it
+        to the history of the room. The message is also given encoded with the
+        binary protocol.
+        """
+        # Messages are encoded once per protocol, and only put in the queues of the
+        # connections: broadcasting does not depend on how fast clients receive
+        # messages
+        connections = self.rooms.get(room, ())
+        print('Broadcast to %s connections in %s' % (len(connections), room))
+        frames: Dict[Protocol, Frame] = {BINARY: data}
+        self.histories.append(room, message, frames)
+        for connection in connections:
+            protocol = connection.protocol
+            frame = frames.get(protocol)
+            if frame is None:
+                frame = frames[protocol] = protocol.encode(message)
+            connection.enqueue(frame)
+
+    def deliver_remote(self, room: str, data: bytes):
+        # Messages are exchanged between processes with the binary protocol
+        self.deliver(room, BINARY.decode(data), data)
 
     async def greet(self, connection: Connection):
         message = Message(
@@ -49,7 +341,7 @@ class ConnectionManager:
             timestamp=datetime.now().isoformat(),
             text=f'{connection.client_id} enters the chat',
         )
-        await self.broadcast(message)
+        await self.broadcast(message, connection.room)
 
     async def bye(self, connection: Connection):
         message = Message(
@@ -57,4 +349,4 @@ class ConnectionManager:
             timestamp=datetime.now().isoformat(),
             text=f'{connection.client_id} disconnected',
         )
-        await self.broadcast(message)
+        await self.broadcast(message, connection.room)
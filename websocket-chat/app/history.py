@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+from .message import Message
+from .protocols import BINARY, Frame, Protocol
+
+
+class HistoryEntry:
+    """
+    A message kept in the history of a room, with its frames: each message is
+    encoded at most once per protocol, either when broadcast or when sent to a
+    client catching up.
+    """
+
+    __slots__ = ('message', 'frames', 'size')
+
+    def __init__(self, message: Message, frames: Dict[Protocol, Frame], size: int):
+        self.message = message
+        self.frames = frames
+        self.size = size
+
+    def frame(self, protocol: Protocol) -> Frame:
+        frame = self.frames.get(protocol)
+        if frame is None:
+            frame = self.frames[protocol] = protocol.encode(self.message)
+        return frame
+
+
+class History:
+    """
+    The last messages of a room, kept in a ring buffer bounded by count and by size
+    (the size of messages encoded with the binary protocol): the oldest messages
+    are removed when either limit is exceeded.
+    """
+
+    def __init__(self, max_count: int = 100, max_bytes: int = 64 * 1024):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.last_id = 0
+        self.size = 0
+        self._entries: Deque[HistoryEntry] = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def next_id(self) -> int:
+        # Ids are microseconds since the epoch, made unique in the room: this way,
+        # ids assigned by different processes are in the order of time
+        self.last_id = max(self.last_id + 1, time.time_ns() // 1000)
+        return self.last_id
+
+    def append(self, entry: HistoryEntry):
+        self.last_id = max(self.last_id, entry.message.id)
+        self._entries.append(entry)
+        self.size += entry.size
+
+        while len(self._entries) > self.max_count or self.size > self.max_bytes:
+            self.size -= self._entries.popleft().size
+
+    def get(self, count: int, since: Optional[int] = None) -> List[HistoryEntry]:
+        """
+        Returns the last `count` messages, or all the messages after the given id.
+        """
+        if since is None:
+            return list(self._entries)[-count:] if count else []
+
+        # Messages published by other processes can arrive slightly out of order:
+        # all the entries are checked
+        return [entry for entry in self._entries if entry.message.id > since]
+
+
+class Histories:
+    """
+    Histories of the rooms, kept also for some time after all clients leave a room,
+    so that clients reconnecting get the messages they missed. The number of
+    histories is bounded: the least recently used are removed.
+    """
+
+    def __init__(
+        self, max_rooms: int = 1000, max_count: int = 100, max_bytes: int = 64 * 1024
+    ):
+        self.max_rooms = max_rooms
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self._rooms: OrderedDict[str, History] = OrderedDict()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def __getitem__(self, room: str) -> History:
+        history = self._rooms.get(room)
+        if history is None:
+            history = self._rooms[room] = History(self.max_count, self.max_bytes)
+            if len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        else:
+            self._rooms.move_to_end(room)
+        return history
+
+    def append(self, room: str, message: Message, frames: Dict[Protocol, Frame]):
+        self[room].append(HistoryEntry(message, frames, len(frames[BINARY])))
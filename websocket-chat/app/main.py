@@ -1,26 +1,88 @@
+import os
 import pathlib
+from typing import Optional
 
-from blacksheep import Application, WebSocket, WebSocketDisconnectError
+from blacksheep import Application, WebSocket, WebSocketDisconnectError, json
 from blacksheep.server.responses import redirect
-from .connection import ConnectionManager
+from blacksheep.server.websocket import WebSocketError
+from .bus import LocalBus, UnixSocketBus
+from .connection import DEFAULT_ROOM, ConnectionManager, OverflowPolicy
+from .protocols import ProtocolError
 
 APP_PATH = pathlib.Path(__file__).parent / 'static'
 
 app = Application()
 app.serve_files(APP_PATH, root_path='app')
 
-manager = ConnectionManager()
+# When running several workers, set CHAT_BUS_SOCKET to the path of a Unix socket
+# shared by the workers, so that messages reach the clients of all workers
+bus_socket = os.environ.get('CHAT_BUS_SOCKET')
+
+# Each connection has a bounded queue of outbound messages: when a client falls
+# behind, the oldest messages in its queue are dropped. Each client can send up to
+# CHAT_MAX_RATE messages per second, and is disconnected after missing two
+# heartbeats, sent every CHAT_HEARTBEAT_INTERVAL seconds
+manager = ConnectionManager(
+    max_queue_size=100,
+    overflow_policy=OverflowPolicy.DROP_OLDEST,
+    bus=UnixSocketBus(bus_socket) if bus_socket else LocalBus(),
+    max_rate=float(os.environ.get('CHAT_MAX_RATE', 10)),
+    burst=20,
+    broadcast_budget=100_000,
+    heartbeat_interval=float(os.environ.get('CHAT_HEARTBEAT_INTERVAL', 30)),
+    max_missed_heartbeats=2,
+)
+
+
+@app.on_start
+async def start_manager():
+    await manager.start()
+
+
+@app.on_stop
+async def stop_manager():
+    await manager.stop()
 
 
 @app.router.ws('/ws/{client_id}')
-async def ws(websocket: WebSocket, client_id: str):
-    conn = await manager.connect(websocket, client_id)
+async def ws(websocket: WebSocket, client_id: str, since: Optional[int] = None):
+    await chat(websocket, DEFAULT_ROOM, client_id, since)
+
+
+@app.router.ws('/ws/{room}/{client_id}')
+async def ws_room(
+    websocket: WebSocket, room: str, client_id: str, since: Optional[int] = None
+):
+    await chat(websocket, room, client_id, since)
+
+
+async def chat(
+    websocket: WebSocket, room: str, client_id: str, since: Optional[int] = None
+):
+    # Clients reconnecting pass the id of the last message they received, to get
+    # only the messages they missed
+    conn = await manager.connect(websocket, client_id, room, since)
 
     try:
         while True:
             await manager.manage(conn)
     except WebSocketDisconnectError:
+        pass
+    except ProtocolError as error:
+        print(f'{client_id} sent an invalid frame, disconnecting: {error}')
         await manager.disconnect(conn)
+        try:
+            await websocket.close(error.code, str(error))
+        except (WebSocketError, OSError):
+            pass
+    finally:
+        # Also when the handler fails, the connection must leave its room
+        await manager.disconnect(conn)
+
+
+@app.router.get('/stats')
+def stats():
+    return json({**manager.stats(), 'pid': os.getpid()})
 
 
 @app.router.get('/')
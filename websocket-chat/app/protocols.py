@@ -0,0 +1,194 @@
+"""
+Protocols used to exchange messages with clients. JSON text frames are used by
+default; clients can negotiate a compact binary protocol, either with the
+WebSocket subprotocol `chat.binary`, or with the `?protocol=binary` query string
+parameter.
+
+Besides messages, the server sends heartbeats (ping frames) to clients, which
+reply with pong frames.
+"""
+import struct
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple, Union
+
+from blacksheep import WebSocket
+from blacksheep.settings.json import json_settings
+from .message import Message
+
+# Messages are queued already encoded: text for JSON, bytes for the binary protocol
+Frame = Union[str, bytes]
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a client sends a frame that cannot be decoded, with the code used to
+    close the connection: 1003 for frames of the wrong type (text instead of binary,
+    or the opposite), 1007 for frames whose content is invalid.
+    """
+
+    def __init__(self, message: str, code: int = 1007) -> None:
+        super().__init__(message)
+        self.code = code
+
+
+class Protocol(ABC):
+    name: str
+    ping: Frame
+
+    @abstractmethod
+    def encode(self, message: Message) -> Frame:
+        """Returns the frame of a message, sent as-is to all recipients."""
+
+    @abstractmethod
+    def batch(self, frames: List[Frame]) -> Frame:
+        """Returns a single frame containing several encoded messages."""
+
+    @abstractmethod
+    def decode(self, frame: Frame) -> Optional[Message]:
+        """
+        Returns the message contained in a frame received from a client, or None
+        for a pong frame. Raises ProtocolError if the frame is invalid.
+        """
+
+    @abstractmethod
+    async def receive(self, socket: WebSocket) -> Optional[Message]:
+        """Receives a message, or a pong frame (None), from a client."""
+
+    @abstractmethod
+    async def send(self, socket: WebSocket, frame: Frame) -> None:
+        """Sends a frame to a client."""
+
+
+class JSONProtocol(Protocol):
+    """
+    Messages are JSON objects, sent in text frames; several messages are sent as an
+    array. Heartbeats are the objects {"type": "ping"} and {"type": "pong"}.
+    """
+
+    name = 'json'
+    ping = json_settings.dumps({'type': 'ping'})
+
+    def encode(self, message: Message) -> str:
+        return message.encode()
+
+    def batch(self, frames: List[Frame]) -> str:
+        return '[' + ','.join(frames) + ']'
+
+    def decode(self, frame: Frame) -> Optional[Message]:
+        if not isinstance(frame, str):
+            raise ProtocolError('Expected a text frame.', 1003)
+        try:
+            data = json_settings.loads(frame)
+        except ValueError:
+            raise ProtocolError('Invalid JSON.')
+        if not isinstance(data, dict):
+            raise ProtocolError('Expected a JSON object.')
+        if data.get('type') == 'pong':
+            return None
+        try:
+            message = Message(
+                author=data['author'],
+                text=data['text'],
+                timestamp=data['timestamp'],
+                id=data.get('id', 0),
+            )
+        except KeyError as error:
+            raise ProtocolError(f'Missing field: {error}.')
+        if not (
+            isinstance(message.author, str)
+            and isinstance(message.text, str)
+            and isinstance(message.timestamp, str)
+            and isinstance(message.id, int)
+        ):
+            raise ProtocolError('Invalid field types.')
+        return message
+
+    async def receive(self, socket: WebSocket) -> Optional[Message]:
+        return self.decode((await socket.receive()).get('text'))
+
+    async def send(self, socket: WebSocket, frame: Frame) -> None:
+        await socket.send_text(frame)
+
+
+class BinaryProtocol(Protocol):
+    """
+    Messages are sent in binary frames: a header with the id of the message and the
+    size of the author, text, and timestamp once encoded in UTF-8 (unsigned
+    integers of 8, 2, 4, and 2 bytes, big-endian), followed by the three fields.
+    Several messages are sent one after the other in the same frame. Heartbeats are
+    frames of a single byte: 1 for ping, 2 for pong.
+    """
+
+    name = 'chat.binary'
+    header = struct.Struct('!QHIH')
+    ping = b'\x01'
+    pong = b'\x02'
+
+    def encode(self, message: Message) -> bytes:
+        author = message.author.encode()
+        text = message.text.encode()
+        timestamp = message.timestamp.encode()
+        return (
+            self.header.pack(message.id, len(author), len(text), len(timestamp))
+            + author
+            + text
+            + timestamp
+        )
+
+    def batch(self, frames: List[Frame]) -> bytes:
+        return b''.join(frames)
+
+    def decode(self, frame: Frame) -> Optional[Message]:
+        if not isinstance(frame, bytes):
+            raise ProtocolError('Expected a binary frame.', 1003)
+        if frame == self.pong:
+            return None
+        try:
+            header = self.header.unpack_from(frame)
+        except struct.error:
+            raise ProtocolError('Invalid frame header.')
+        message_id, author_size, text_size, timestamp_size = header
+        start = self.header.size
+        text_start = start + author_size
+        timestamp_start = text_start + text_size
+        if timestamp_start + timestamp_size != len(frame):
+            raise ProtocolError('Invalid frame size.')
+        try:
+            return Message(
+                author=frame[start:text_start].decode(),
+                text=frame[text_start:timestamp_start].decode(),
+                timestamp=frame[timestamp_start:].decode(),
+                id=message_id,
+            )
+        except UnicodeDecodeError:
+            raise ProtocolError('Invalid UTF-8 text.')
+
+    async def receive(self, socket: WebSocket) -> Optional[Message]:
+        # The message has no bytes if the client sent a text frame
+        return self.decode((await socket.receive()).get('bytes'))
+
+    async def send(self, socket: WebSocket, frame: Frame) -> None:
+        await socket.send_bytes(frame)
+
+
+JSON = JSONProtocol()
+BINARY = BinaryProtocol()
+
+PROTOCOLS: Dict[str, Protocol] = {'json': JSON, 'binary': BINARY}
+
+
+def negotiate(websocket: WebSocket) -> Tuple[Protocol, Optional[str]]:
+    """
+    Returns the protocol requested by a client, and the subprotocol to confirm when
+    accepting the connection, if the client requested one.
+    """
+    header = websocket.get_first_header(b'Sec-WebSocket-Protocol')
+    if header:
+        offered = [value.strip() for value in header.decode().split(',')]
+        if BINARY.name in offered:
+            return BINARY, BINARY.name
+
+    names = websocket.query.get('protocol')
+    if names and names[0] in PROTOCOLS:
+        return PROTOCOLS[names[0]], None
+    return JSON, None
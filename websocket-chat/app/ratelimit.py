@@ -0,0 +1,32 @@
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a constant rate, up to a maximum burst.
+
+    Tokens are taken even when they are not available: the bucket goes into debt,
+    and the caller waits for the time needed to repay it. This way, a cost higher
+    than the burst (like a broadcast to a big room) is delayed, but not refused.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """
+        Takes tokens from the bucket, and returns the number of seconds to wait
+        before proceeding (0 if the tokens were available).
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
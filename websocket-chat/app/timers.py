@@ -0,0 +1,57 @@
+import asyncio
+from typing import Callable, Dict, Generic, List, Optional, Set, TypeVar
+
+T = TypeVar('T')
+
+
+class TimerWheel(Generic[T]):
+    """
+    Calls a function for each item once per interval, using a single timer for all
+    items, instead of a sleeping task per item.
+
+    Items are spread over the slots of a wheel, which turns once per interval: at
+    each tick, the function is called for the items of one slot. Adding and
+    removing items cost O(1), and the work is spread over the interval instead of
+    being done for all items at once.
+    """
+
+    def __init__(
+        self, interval: float, callback: Callable[[T], None], slots: int = 10
+    ):
+        self.interval = interval
+        self.callback = callback
+        self._slots: List[Set[T]] = [set() for _ in range(slots)]
+        self._slot_of: Dict[T, int] = {}
+        self._position = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def add(self, item: T):
+        # The slot just behind the hand of the wheel: the function is called for
+        # the item about one interval from now
+        slot = (self._position - 1) % len(self._slots)
+        self._slots[slot].add(item)
+        self._slot_of[item] = slot
+
+    def remove(self, item: T):
+        slot = self._slot_of.pop(item, None)
+        if slot is not None:
+            self._slots[slot].discard(item)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        tick = self.interval / len(self._slots)
+        while True:
+            await asyncio.sleep(tick)
+            # The callback can remove items from the slot
+            for item in list(self._slots[self._position]):
+                self.callback(item)
+            self._position = (self._position + 1) % len(self._slots)
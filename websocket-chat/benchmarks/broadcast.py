@@ -0,0 +1,82 @@
+"""
+Compares the CPU time spent broadcasting a chat message, when the message is
+serialized for each recipient (dataclasses.asdict and send_json, as done before),
+and when it is encoded once into a text frame sent as-is to all recipients.
+
+Sockets are real BlackSheep WebSocket objects, bound to an ASGI send callable that
+discards messages.
+
+Usage (from the websocket-chat folder):
+    python -m benchmarks.broadcast
+"""
+import asyncio
+import dataclasses
+import time
+from typing import List
+
+from blacksheep import WebSocket
+from blacksheep.server.websocket import WebSocketState
+
+from app.message import Message
+
+BROADCASTS = 20
+
+
+async def receive():
+    return {'type': 'websocket.connect'}
+
+
+async def send(message):
+    pass
+
+
+def new_socket() -> WebSocket:
+    scope = {
+        'type': 'websocket',
+        'path': '/ws/benchmark',
+        'query_string': b'',
+        'headers': [],
+    }
+    socket = WebSocket(scope, receive, send)
+    socket.client_state = WebSocketState.CONNECTED
+    return socket
+
+
+async def broadcast_per_recipient(sockets: List[WebSocket], message: Message):
+    for socket in sockets:
+        await socket.send_json(dataclasses.asdict(message))
+
+
+async def broadcast_encoded_once(sockets: List[WebSocket], message: Message):
+    frame = message.encode()
+    for socket in sockets:
+        await socket.send_text(frame)
+
+
+async def measure(broadcast, sockets: List[WebSocket]) -> float:
+    message = Message(
+        author='benchmark',
+        text='Hello, World! ' * 4,
+        timestamp='2024-01-01T00:00:00.000000',
+    )
+    started = time.process_time()
+    for _ in range(BROADCASTS):
+        await broadcast(sockets, message)
+    return (time.process_time() - started) / BROADCASTS
+
+
+async def main():
+    print(f'{"connections":>12} {"per recipient":>16} {"encoded once":>16} {"ratio":>8}')
+
+    for count in (1_000, 10_000, 50_000):
+        sockets = [new_socket() for _ in range(count)]
+        before = await measure(broadcast_per_recipient, sockets)
+        after = await measure(broadcast_encoded_once, sockets)
+        print(
+            f'{count:>12,} {before * 1000:>13.2f} ms {after * 1000:>13.2f} ms '
+            f'{before / after:>7.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,176 @@
+"""
+Measures how many chat messages per second are delivered to clients, when the
+application runs with an increasing number of worker processes sharing a
+UnixSocketBus.
+
+For each number of workers, the script starts uvicorn, connects the clients to one
+room (spread over several client processes, so that the load generator is not the
+bottleneck), and has some of them send messages. Throughput is the number of
+messages received by all clients, divided by the time between the first message
+sent and the last message received. Throughput grows with the number of workers
+as long as the machine has free cores, since each worker only sends messages to
+its own clients.
+
+Usage (from the websocket-chat folder):
+    python -m benchmarks.loadtest --workers 1 2 4 --clients 400
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+import websockets
+
+AUTHOR = 'loadtest'
+PONG = json.dumps({'type': 'pong'})
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('localhost', port), 0.1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'The server did not start on port {port}')
+
+
+async def run_clients(
+    index: int,
+    url: str,
+    clients: int,
+    senders: int,
+    messages: int,
+    barrier,
+) -> Tuple[int, float, float]:
+    sockets = [
+        await websockets.connect(url.format(f'client-{index}-{i}'))
+        for i in range(clients)
+    ]
+    last_received = 0.0
+    received = 0
+
+    async def receive(ws):
+        nonlocal last_received, received
+        try:
+            while True:
+                # Messages stop arriving when all were sent, or when some were
+                # dropped by the server because the client fell behind
+                frame = await asyncio.wait_for(ws.recv(), 2)
+                data = json.loads(frame)
+                # Missed messages are sent in an array when a client connects
+                for message in data if isinstance(data, list) else (data,):
+                    if message.get('type') == 'ping':
+                        await ws.send(PONG)
+                    elif message.get('author') == AUTHOR:
+                        received += 1
+                        last_received = time.time()
+        except asyncio.TimeoutError:
+            pass
+
+    async def send(ws):
+        for i in range(messages):
+            await ws.send(
+                json.dumps({'author': AUTHOR, 'text': f'message {i}', 'timestamp': ''})
+            )
+            # Lets the receiving side of this process run
+            await asyncio.sleep(0)
+
+    # Waits for the greetings of all clients, then for all processes to be ready
+    await asyncio.sleep(1)
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    started = time.time()
+
+    tasks = [asyncio.create_task(receive(ws)) for ws in sockets]
+    if index == 0:
+        tasks.extend(asyncio.create_task(send(ws)) for ws in sockets[:senders])
+    await asyncio.gather(*tasks)
+
+    for ws in sockets:
+        await ws.close()
+    return received, started, last_received
+
+
+def client_process(args) -> Tuple[int, float, float]:
+    return asyncio.run(run_clients(*args))
+
+
+def measure(workers: int, args) -> Tuple[int, float]:
+    bus_socket = f'/tmp/blacksheep-chat-loadtest-{os.getpid()}.sock'
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            '-m',
+            'uvicorn',
+            'server:app',
+            '--port',
+            str(args.port),
+            '--workers',
+            str(workers),
+            '--log-level',
+            'warning',
+        ],
+        # Senders are not rate limited, to measure the throughput of the server
+        env={**os.environ, 'CHAT_BUS_SOCKET': bus_socket, 'CHAT_MAX_RATE': '1e9'},
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.port)
+        # Gives the workers the time to elect the hub of the bus
+        time.sleep(1)
+
+        url = f'ws://localhost:{args.port}/ws/loadtest/{{}}'
+        processes = args.client_processes
+        manager = multiprocessing.Manager()
+        barrier = manager.Barrier(processes)
+        jobs = [
+            (i, url, args.clients // processes, args.senders, args.messages, barrier)
+            for i in range(processes)
+        ]
+        with multiprocessing.Pool(processes) as pool:
+            results: List[Tuple[int, float, float]] = pool.map(client_process, jobs)
+    finally:
+        server.terminate()
+        server.wait()
+
+    received = sum(result[0] for result in results)
+    started = min(result[1] for result in results)
+    finished = max(result[2] for result in results)
+    return received, finished - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=400)
+    parser.add_argument('--client-processes', type=int, default=4)
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--port', type=int, default=8099)
+    args = parser.parse_args()
+
+    clients = args.clients // args.client_processes * args.client_processes
+    expected = clients * args.senders * args.messages
+    print(
+        f'{clients} clients, {args.senders} senders x {args.messages} messages, '
+        f'{expected:,} deliveries expected ({os.cpu_count()} CPUs)'
+    )
+    print(f'{"workers":>8} {"delivered":>10} {"seconds":>8} {"messages/s":>11}')
+
+    for workers in args.workers:
+        received, elapsed = measure(workers, args)
+        print(
+            f'{workers:>8} {received / expected:>10.1%} {elapsed:>8.2f} '
+            f'{received / elapsed:>11,.0f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
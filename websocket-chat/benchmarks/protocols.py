@@ -0,0 +1,61 @@
+"""
+Compares the JSON and binary protocols: size of the frames, and CPU time spent for
+a round trip (encoding a message, and decoding the frame back into a message).
+
+Usage (from the websocket-chat folder):
+    python -m benchmarks.protocols
+"""
+import time
+
+from app.message import Message
+from app.protocols import BINARY, JSON, Protocol
+
+ROUND_TRIPS = 100_000
+
+MESSAGES = {
+    'short': Message(
+        author='alice',
+        text='Hello!',
+        timestamp='2024-01-01T00:00:00.000Z',
+    ),
+    'long': Message(
+        author='alice',
+        text='Hello, World! ' * 40,
+        timestamp='2024-01-01T00:00:00.000Z',
+    ),
+}
+
+
+def frame_size(protocol: Protocol, message: Message) -> int:
+    frame = protocol.encode(message)
+    return len(frame.encode() if isinstance(frame, str) else frame)
+
+
+def measure(protocol: Protocol, message: Message) -> float:
+    started = time.process_time()
+    for _ in range(ROUND_TRIPS):
+        protocol.decode(protocol.encode(message))
+    return (time.process_time() - started) / ROUND_TRIPS
+
+
+def main():
+    for protocol in (JSON, BINARY):
+        for message in MESSAGES.values():
+            assert protocol.decode(protocol.encode(message)) == message
+
+    print(
+        f'{"message":>8} {"protocol":>12} {"bytes":>6} {"round trip":>12} '
+        f'{"ratio":>6}'
+    )
+    for name, message in MESSAGES.items():
+        baseline = measure(JSON, message)
+        for protocol in (JSON, BINARY):
+            elapsed = baseline if protocol is JSON else measure(protocol, message)
+            print(
+                f'{name:>8} {protocol.name:>12} {frame_size(protocol, message):>6} '
+                f'{elapsed * 1e6:>9.2f} µs {baseline / elapsed:>5.1f}x'
+            )
+
+
+if __name__ == '__main__':
+    main()